@@ -3,6 +3,8 @@
 import argparse
 import asyncio
 from lib import ai_constructor, CV, Mode
+from lib.memory import BACKENDS
+from lib.hedge import PERCENTILE
 
 
 def parse_args() -> argparse.Namespace:
@@ -17,6 +19,16 @@ def parse_args() -> argparse.Namespace:
       3. --speaker, -s : VOICEVOX キャラクターボイスを指定する。
           strまたはintを指定する。デフォルトは0。
       4. --yaml, -y : AIカスタム設定YAMLのファイルパスを指定する。デフォルトはNone。
+      5. --speculate : 質問待受タイムアウト時の回答を入力待ちの間に先に生成する。
+          生成に使うtoken数の上限を指定する。デフォルトは0で生成しない。
+      6. --memory : 長期記憶のストレージを指定する。
+          gist, sharded(Gist上に分割保存), sqlite(ローカル)のいずれか。
+          デフォルトはNoneで、--yaml指定がなければgist、あれば記憶しない。
+      7. --hedge : 最初のtokenが遅いときに予備の要求を送る。
+          モデル名を指定すると予備の要求をそのモデルへ送る。
+      8. --hedge-percentile : 予備の要求を送る期限とする、
+          最初のtokenまでの時間の分位点(0より大きく1以下)。デフォルトは0.95。
+      9. --resume : 前回の会話履歴と要約をジャーナルから復元して会話を続ける。
     - 引数を解析した結果をargparse.Namespaceオブジェクトに格納し、戻り値として返す。
     """
     cv_list = "\n".join(str(t) for t in CV.items().items())
@@ -39,8 +51,8 @@ Listening mode ユーザーの入力をキーボードからではなくマイ
     parser.add_argument(
         "--model",
         "-m",
-        default="gpt-3.5-turbo",
-        help="ChatGPTモデル(default=gpt-3.5-turbo)",
+        default=None,
+        help="ChatGPTモデル(default=YAMLのprovider.modelまたはgpt-3.5-turbo)",
     )
     parser.add_argument(
         "--speaker",
@@ -62,6 +74,42 @@ AI音声の生成先 (-v=SLOW, -vv=FAST, -vvv=LOCAL, default=None = 音声で話
         default=None,
         help="AIカスタム設定YAMLのファイルパス",
     )
+    parser.add_argument(
+        "--speculate",
+        type=int,
+        default=0,
+        help="""
+タイムアウト時の回答を入力待ちの間に先に生成する。生成に使うtoken数の上限(default=0 = 生成しない)""",
+    )
+    parser.add_argument(
+        "--memory",
+        choices=BACKENDS,
+        default=None,
+        help="""
+長期記憶のストレージ(default=None = --yaml指定がなければgist、あれば記憶しない)""",
+    )
+    parser.add_argument(
+        "--hedge",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="MODEL",
+        help="""
+最初のtokenが遅いときに予備の要求を送る。MODELを指定するとそのモデルへ送る(default=None = 送らない)""",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=PERCENTILE,
+        help=f"""
+予備の要求を送る期限とする最初のtokenまでの時間の分位点。
+小さくすると早めに予備の要求を送る(default={PERCENTILE})""",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="前回の会話履歴と要約をローカルのジャーナルから復元して会話を続ける",
+    )
     return parser.parse_args()
 
 
@@ -72,7 +120,12 @@ if __name__ == "__main__":
                         name=args.character,
                         speaker=args.speaker,
                         voice=Mode(args.voice),
-                        character_file=args.yaml)
+                        character_file=args.yaml,
+                        speculate=args.speculate,
+                        memory=args.memory,
+                        hedge=args.hedge,
+                        hedge_percentile=args.hedge_percentile,
+                        resume=args.resume)
     # Start chat
-    print("空行で入力確定, qまたはexitで会話終了")
-    asyncio.run(ai.ask())
+    print("空行で入力確定, qまたはexitで会話終了, Ctrl-Cで回答を中断")
+    asyncio.run(ai.ask(ai.resumed))
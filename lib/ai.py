@@ -3,31 +3,24 @@
 過去の会話を長期記憶としてのgistから取得し、
 要約した会話履歴を長期記憶としてgistへ保存する
 """
-import os
 import sys
 import json
 from enum import Enum, auto
 from collections import namedtuple
-from typing import Optional
+from typing import Optional, Callable
 import random
-from time import sleep
 from itertools import cycle
+from contextlib import contextmanager
+import signal
 import asyncio
 import wave
-import yaml
 import aiohttp
 import tiktoken
 from .voicevox_character import CV, Mode
+from .provider import Provider
 
-# ChatGPT API Key
-API_KEY = os.environ["CHATGPT_API_KEY"]
-# ChatGPT API Endpoint
-ENDPOINT = "https://api.openai.com/v1/chat/completions"
-# ChatGPT API header
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {API_KEY}"
-}
+# APIの応答を待つ最大時間(秒)
+REQUEST_TIMEOUT = 300
 # アシスタントが書き込む間隔(秒)
 INTERVAL = 0.02
 # 質問待受時間(秒)
@@ -36,6 +29,21 @@ TIMEOUT = 300
 CONFIG_FILE = "character.yml"
 # 質問待受で表示されるプロンプト
 PROMPT = "あなた: "
+# 要約を並列に作成するときの同時リクエスト数
+SUMMARIZE_CONCURRENCY = 3
+# 429 Too Many Requestsのときに再試行する回数
+MAX_RETRIES = 4
+# 再試行までの待ち時間(秒)。再試行のたびに倍にする
+RETRY_WAIT = 2.0
+# 質問待受がタイムアウトしたときの返答
+SILENT_INPUT = [
+    "",
+    "続けて",
+    "他の話題は？",
+    "これまでの話題から一つピックアップして",
+]
+# 中断された回答の末尾に付ける印
+TRUNCATED = "…(中断)"
 # 会話履歴の形式
 Message = namedtuple("Message", ["role", "content"])
 
@@ -53,8 +61,9 @@ class Role(Enum):
 
 
 class TooManyRequestsError(Exception):
-    def __init__(self, message):
+    def __init__(self, message, retry_after: Optional[float] = None):
         self.message = message
+        self.retry_after = retry_after  # Retry-Afterヘッダーの秒数
 
 
 async def spinner():
@@ -74,27 +83,69 @@ def get_content(resp_json: dict) -> str:
     return content
 
 
-def print_one_by_one(text):
+def get_delta(line: bytes) -> str:
+    """ストリーミングレスポンスの1行からAIの回答の差分を取得
+    data: {"choices": [{"delta": {"content": "..."}}]} 形式以外の行は空文字を返す
+    """
+    line = line.decode("utf-8").strip()
+    if not line.startswith("data:"):
+        return ""
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return ""
+    try:
+        delta = json.loads(payload)['choices'][0]['delta']
+    except KeyError as k_e:
+        raise KeyError(f"キーが見つかりません。{payload}") from k_e
+    return delta.get('content') or ""
+
+
+async def print_one_by_one(text):
     """一文字ずつ出力"""
     for char in f"{text}\n":
-        try:
-            print(char, end="", flush=True)
-            sleep(INTERVAL)
-        except KeyboardInterrupt:
-            return
+        print(char, end="", flush=True)
+        await asyncio.sleep(INTERVAL)
 
 
-async def wait_for_input(timeout: float, mic_input=False) -> str:
+@contextmanager
+def interruptible(task: asyncio.Task, listen: bool = False):
+    """Ctrl-C、またはlisten=Trueならユーザーの発話(barge-in)でtaskを中断する"""
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        handled = True
+    except (NotImplementedError, RuntimeError):  # Windowsなど
+        handled = False
+    barge_in = None
+    if listen:
+        from .mic_input import async_detect_speech
+
+        def on_speech(detector: asyncio.Task):
+            if detector.cancelled() or detector.exception() is not None:
+                return
+            if detector.result():
+                task.cancel()
+
+        barge_in = asyncio.create_task(async_detect_speech())
+        barge_in.add_done_callback(on_speech)
+    try:
+        yield
+    finally:
+        if handled:
+            loop.remove_signal_handler(signal.SIGINT)
+        if barge_in is not None:
+            barge_in.cancel()
+
+
+async def wait_for_input(timeout: float,
+                         mic_input=False,
+                         silent: Optional[str] = None) -> str:
     """一定時間内に入力があればその入力を返し、そうでなければランダムな返答を返す関数。
-    Parameter: 入力を待つ最大時間（秒単位）
+    Parameter:
+        timeout: 入力を待つ最大時間（秒単位）
+        silent: タイムアウト時の返答。Noneならランダムに選ぶ
     Return: 入力があった場合はその入力、なかった場合はランダムに選ばれた返答
     """
-    silent_input = [
-        "",
-        "続けて",
-        "他の話題は？",
-        "これまでの話題から一つピックアップして",
-    ]
     try:
         if mic_input:
             from .mic_input import async_mic_input
@@ -109,15 +160,27 @@ async def wait_for_input(timeout: float, mic_input=False) -> str:
         input_task.cancel()
         raise
     except asyncio.TimeoutError:
+        # 入力待ちを止めて、次の入力待ちに入力を渡す
+        input_task.cancel()
         # タイムアウトしたらランダムな質問を返す
-        return random.choice(silent_input)
+        if silent is None:
+            silent = random.choice(SILENT_INPUT)
+        return silent
     except KeyboardInterrupt:
         sys.exit(1)
 
 
 async def async_input() -> str:
-    """ユーザーinputを非同期に待つ"""
-    return await asyncio.get_running_loop().run_in_executor(None, multi_input)
+    """ユーザーinputを非同期に待つ
+    イベントループ上で標準入力を読むので、キャンセルしてもスレッドが残らない。
+    add_readerが使えない環境(Windowsなど)ではスレッドでinput()を待つ。
+    """
+    from .stdin_reader import get_reader
+    try:
+        return await get_reader().multi_input(PROMPT)
+    except NotImplementedError:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, multi_input)
 
 
 def multi_input() -> str:
@@ -151,7 +214,12 @@ class AI:
                  voice: Mode = Mode.NONE,
                  listen: bool = False,
                  model: str = "gpt-3.5-turbo",
-                 speaker: CV = CV.四国めたんノーマル):
+                 speaker: CV = CV.四国めたんノーマル,
+                 history_budget: int = 2000,
+                 keep_turns: int = 3,
+                 provider: Optional[dict] = None,
+                 summary_provider: Optional[dict] = None,
+                 tts: Optional[dict] = None):
         # YAMLから設定するオプション
         self.name = name  # AIキャラ名
         self.max_tokens = max_tokens
@@ -162,14 +230,41 @@ class AI:
         self.chat_summary = chat_summary  # 会話履歴
         self.voice = voice  # 音声の生成先
         self.listen = listen  # Trueで入力をマイクから拾う
-        self.model = model  # ChatGPT モデル
+        # 会話用と要約用のAPIの接続先
+        # 要約用の指定がなければ会話用と同じ接続先を使う
+        self.provider = Provider.from_config(provider)
+        self.summary_provider = Provider.from_config(
+            provider if summary_provider is None else summary_provider)
+        self.model = self.provider.model or model  # ChatGPT モデル
+        self.model_fixed = False  # Trueでコマンドライン指定のmodelを保持
         # AIの発話用テキスト読み上げキャラクターを設定
         self.speaker = self.set_speaker(speaker)
-
-    async def post(self, chat_messages: list[Message]) -> list[Message]:
+        self.speaker_fixed = False  # Trueでコマンドライン指定のspeakerを保持
+        # 読み上げ前の前処理の設定(max_chars, code, url)
+        self.tts = tts or {}
+        self.tts_saved = 0  # 前処理で読み上げを省いた文字数の合計
+        self.journal = None  # 会話の追記専用ジャーナル
+        self.resumed: list[Message] = []  # ジャーナルから復元した会話履歴
+        self.catalog = None  # キャラクタ設定の再読み込み元
+        self.speculator = None  # タイムアウト時の回答の投機的生成
+        self.hedger = None  # 応答が遅いときの予備の要求
+        # 会話履歴(chat_messages)のtoken数の上限
+        self.history_budget = history_budget
+        # 上限を超えても会話履歴にそのまま残す直近の往復数
+        self.keep_turns = keep_turns
+        self.folded: Optional[Message] = None  # 要約へ取り込み済みの最後の会話
+        self._summary_seq = 0  # 要約を始めた回数
+        self._folded_seq = 0  # 完了した要約のうち最新のもの
+        self._save_lock: Optional[asyncio.Lock] = None  # 長期記憶への保存を1つずつ行う
+
+    async def post(self,
+                   chat_messages: list[Message],
+                   partial: Optional[list[str]] = None) -> list[Message]:
         """AI.post
         ユーザーの入力を受け取り、ChatGPT APIにPOSTし、AIの応答を返す
         APIへ渡す前にtoken数を計算して、最初の方の会話から取り除く
+        回答はストリーミングで受け取り、届いた差分を順にpartialへ追加する。
+        中断(キャンセル)されたら接続を閉じて以降の生成を止める。
         """
         messages = []
         while True:
@@ -187,8 +282,14 @@ class AI:
             # system_role, summary, messagesの中で最も重要度の低い
             # summaryの１行目を削除する
             chuncks = self.chat_summary.split("\n")
-            chuncks.pop(1)
-            self.chat_summary = "\n".join(chuncks)
+            if len(chuncks) > 1:
+                chuncks.pop(1)
+                self.chat_summary = "\n".join(chuncks)
+            elif len(chat_messages) > 1:
+                # summaryを削りきったら最も古い会話を捨てる
+                chat_messages = chat_messages[1:]
+            else:  # これ以上削れない
+                break
             # Summaryの一行目は # Summary Contentなのでpop(1)
             #
             # ai.chat_summaryの例
@@ -217,31 +318,125 @@ class AI:
             "model": self.model,
             "max_tokens": self.max_tokens,
             "temperature": self.temperature,
-            "messages": [m._asdict() for m in messages]
+            "messages": [m._asdict() for m in messages],
+            "stream": True,
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(ENDPOINT,
-                                    headers=HEADERS,
+        if partial is None:
+            partial = []
+        if self.hedger is None:
+            content = await self.stream(data, partial)
+        else:  # 最初のtokenが遅ければ2つ目の要求を送り、早い方を使う
+            content = await self.hedger.run(self, data, partial)
+        messages.append(Message(str(Role.ASSISTANT), content))  # append answer
+        return messages[1:]  # remove system role & summary
+
+    async def stream(self,
+                     data: dict,
+                     partial: list[str],
+                     on_first: Optional[Callable[[], None]] = None) -> str:
+        """ChatGPT APIにPOSTし、回答をストリーミングで受け取る
+        届いた差分を順にpartialへ追加し、最初の差分が届いたらon_firstを呼ぶ
+        """
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(self.provider.endpoint,
+                                    headers=self.provider.headers(),
                                     data=json.dumps(data)) as response:
                 if response.status == 429:
                     raise TooManyRequestsError("Too many requests")
                 elif response.status != 200:
                     raise ValueError('{}: {}'.format(response.status,
-                                                     response.json()))
-                ai_response = await response.json()
-        content = get_content(ai_response)
-        messages.append(Message(str(Role.ASSISTANT), content))  # append answer
-        return messages[1:]  # remove system role & summary
+                                                     await response.text()))
+                async for line in response.content:
+                    delta = get_delta(line)
+                    if not delta:
+                        continue
+                    if not partial and on_first is not None:
+                        on_first()
+                    partial.append(delta)
+        return "".join(partial)
 
     def is_over_limit(self, contents: str) -> bool:
         """modelのAPI token上限を超えているか"""
         tokens = self.token_length(contents)
-        limit = 4096
+        limit = self.provider.token_limit
         return tokens >= (limit - self.max_tokens)
 
+    def encoding(self):
+        """modelのtokenizer"""
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except KeyError:  # ローカルの推論サーバーのモデルなど
+            return tiktoken.get_encoding("cl100k_base")
+
     def token_length(self, contents: str) -> int:
-        enc = tiktoken.encoding_for_model(self.model)
-        return len(enc.encode(contents))
+        return len(self.encoding().encode(contents))
+
+    def history_tokens(self, chat_messages: list[Message]) -> int:
+        """会話履歴のtoken数"""
+        return self.token_length("\n".join([m.content for m in chat_messages]))
+
+    def folded_count(self, chat_messages: list[Message]) -> int:
+        """会話履歴の先頭から要約へ取り込み済みの会話の数"""
+        for i, m in enumerate(chat_messages):
+            if m is self.folded:
+                return i + 1
+        return 0
+
+    def compact(self, chat_messages: list[Message]) -> list[Message]:
+        """会話履歴がhistory_budgetを超えたら古い会話を取り除く
+        直近keep_turns往復はそのまま残し、それより古い会話のうち
+        要約(chat_summary)へ取り込み済みのものから取り除く。
+        要約が追いつかずに上限を超えたままなら、要約前の会話でも古いものから捨てる。
+        """
+        if self.history_tokens(chat_messages) <= self.history_budget:
+            return chat_messages
+        oldest_kept = max(len(chat_messages) - 2 * self.keep_turns, 0)
+        compacted = chat_messages[min(self.folded_count(chat_messages),
+                                      oldest_kept):]
+        while (len(compacted) > 2 * self.keep_turns
+               and self.history_tokens(compacted) > self.history_budget):
+            compacted = compacted[1:]
+        # 会話履歴はユーザーの発言から始める
+        while len(compacted) > 1 and compacted[0].role != str(Role.USER):
+            compacted = compacted[1:]
+        return compacted
+
+    def record(self, record: dict):
+        """ジャーナルがあればレコードを追記する"""
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def record_message(self, message: Message):
+        """会話をジャーナルへ追記する"""
+        self.record({"type": "message", **message._asdict()})
+
+    def resume(self, max_messages: Optional[int] = None) -> list[Message]:
+        """ジャーナルの末尾から直近の会話履歴と要約を復元する
+        長期記憶へ保存されていない要約があれば保存し直す
+        Return: 復元した会話履歴
+        """
+        from .journal import RESUME_MESSAGES
+        records, summary, unsaved = self.journal.tail(max_messages
+                                                      or RESUME_MESSAGES)
+        if summary is not None:
+            self.chat_summary = summary
+            if unsaved and self.gist is not None:
+                from .journal import summary_id
+                self.gist.patch(summary)
+                self.record({"type": "saved", "id": summary_id(summary)})
+        chat_messages = [Message(r["role"], r["content"]) for r in records]
+        return self.compact(chat_messages)
+
+    def speech_text(self, text: str) -> str:
+        """音声合成へ渡すテキスト
+        Markdownの記号やコードブロック、URLを取り除いて読み上げる量を減らし、
+        減らした文字数をtts_savedへ積算する
+        """
+        from .tts_text import preprocess
+        speech, saved = preprocess(text, **self.tts)
+        self.tts_saved += saved
+        return speech
 
     def set_speaker(self, sp):
         """ AI.speakerの判定
@@ -260,14 +455,38 @@ class AI:
 
     async def summarize(self, chat_messages: list[Message]):
         """要約用のChatGPT: Summarizerを呼び出して要約文を作成し、
-        要約文をgistへアップロードする。
+        要約文を長期記憶(gist)へアップロードする。
         """
         summarizer = Summarizer(self.name, self.filename, self.gist,
-                                self.chat_summary)
+                                self.chat_summary, self.summary_provider)
+        self._summary_seq += 1
+        seq = self._summary_seq
         # 要約文を作成
-        self.chat_summary = await summarizer.post(chat_messages)
-        # 要約文をGistへ保存
-        self.gist.patch(self.chat_summary)
+        chat_summary = await summarizer.post(chat_messages)
+        if seq < self._folded_seq:  # 後から始めた要約が先に完了していたら破棄
+            return
+        self._folded_seq = seq
+        # 重複した箇条書きをまとめてから保存する
+        from .summary_dedup import compact_summary
+        chat_summary, _ = compact_summary(chat_summary)
+        self.chat_summary = chat_summary
+        self.folded = chat_messages[-1]  # ここまでの会話は要約へ取り込み済み
+        from .journal import summary_id
+        sid = summary_id(chat_summary)
+        self.record({"type": "summary", "id": sid, "content": chat_summary})
+        # 要約文を長期記憶へ保存
+        # 保存は1つずつ行い、待つ間に後から始めた要約が完了していれば
+        # 古い要約は保存しない(新しい要約が後で保存される)
+        if self.gist is not None:
+            if self._save_lock is None:
+                self._save_lock = asyncio.Lock()
+            async with self._save_lock:
+                if seq < self._folded_seq:
+                    return
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.gist.patch,
+                                           chat_summary)
+                self.record({"type": "saved", "id": sid})
         del summarizer
 
     async def ask(self, chat_messages: list[Message] = []):
@@ -276,33 +495,103 @@ class AI:
         while user_input.strip() == "":  # 入力待受
             # 待っても入力がなければ、再度質問待ち
             # 入力があればループを抜け回答を考えてもらう
+            silent = random.choice(SILENT_INPUT)
+            if self.speculator is not None:
+                # 入力待ちの間にタイムアウト時の回答を先に考えておく
+                self.speculator.start(chat_messages, silent)
             try:
-                user_input = await wait_for_input(TIMEOUT, self.listen)
+                user_input = await wait_for_input(TIMEOUT, self.listen,
+                                                  silent)
                 user_input = user_input.replace("/n", " ")
                 if user_input.strip() in ("q", "exit"):
+                    if self.tts_saved:
+                        print(f"読み上げの前処理で{self.tts_saved}文字を省きました。")
                     raise SystemExit
             except KeyboardInterrupt:
                 print()
+        # キャラクタ設定が更新されていれば会話を保ったまま差し替える
+        if self.catalog is not None:
+            self.catalog.refresh(self)
+        # 投機的に生成済みの回答があれば使い、なければ破棄する
+        speculated = None
+        if self.speculator is not None:
+            speculated = await self.speculator.take(user_input)
         # ユーザーの入力を会話履歴に追加
         chat_messages.append(Message(str(Role.USER), user_input))
+        self.record_message(chat_messages[-1])
+        # 回答の生成と、音声再生から表示までをそれぞれ中断可能なタスクとして進める
+        partial: list[str] = []
+        turn = asyncio.create_task(self.answer(chat_messages, speculated,
+                                               partial))
+        with interruptible(turn, self.listen):
+            await asyncio.wait({turn})
+        if turn.cancelled():
+            # 生成中に中断されたら途中までの回答を表示し、
+            # 打ち切られた回答として会話履歴に残す
+            print(f"\n{self.name}: {''.join(partial)}{TRUNCATED}")
+            response_messages = chat_messages + [
+                Message(str(Role.ASSISTANT), "".join(partial) + TRUNCATED)
+            ]
+        else:
+            response_messages, audio = turn.result()
+            # 会話の要約をバックグラウンドで進める非同期処理
+            asyncio.create_task(self.summarize(response_messages))
+            # 生成を終えた回答は再生と表示を中断しても完全な回答として残す
+            presentation = asyncio.create_task(
+                self.present(response_messages[-1].content, audio))
+            with interruptible(presentation, self.listen):
+                await asyncio.wait({presentation})
+        self.record_message(response_messages[-1])
+        # 要約へ取り込まれた古い会話を会話履歴から取り除く
+        response_messages = self.compact(response_messages)
+        # 次の質問
+        await self.ask(response_messages)
+
+    async def answer(self, chat_messages: list[Message], speculated,
+                     partial: list[str]):
+        """回答の生成
+        speculatedに投機的に生成済みの(response_messages, audio)があれば使う
+        Return: (response_messages, 合成済みの音声またはNone)
+        """
+        if speculated is not None:
+            response_messages, audio = speculated
+            partial.append(response_messages[-1].content)
+            return response_messages, audio
         # 回答を考えてもらう
         spinner_task = asyncio.create_task(spinner())  # スピナー表示
         # ai_responseが出てくるまで待つ
-        response_messages = await self.post(chat_messages)
-        ai_response = response_messages[-1].content
-        spinner_task.cancel()
-        # 会話の要約をバックグラウンドで進める非同期処理
-        asyncio.create_task(self.summarize(response_messages))
-        # 音声出力オプションがあれば、音声の再生
-        if self.voice > 0:
-            from lib.voicevox_audio import play_voice
-            try:
-                play_voice(ai_response, self.speaker, self.voice)
-            except (EOFError, wave.Error) as wav_e:
-                print("Error: 音声再生中にエラーが発生しました。", f"{wav_e}無視してテキストを表示します。")
-        print_one_by_one(f"{self.name}: {ai_response}\n")
-        # 次の質問
-        await self.ask(response_messages)
+        try:
+            response_messages = await self.post(chat_messages, partial)
+        finally:
+            spinner_task.cancel()
+        return response_messages, None
+
+    async def present(self, ai_response: str, audio=None):
+        """回答の音声再生と表示
+        再生中に中断されたら再生を止めて回答を一度に表示し、
+        表示中に中断されたら表示を止める
+        """
+        try:
+            # 音声出力オプションがあれば、音声の再生
+            if self.voice > 0:
+                from lib.voicevox_audio import async_play_voice, async_play_audio
+                try:
+                    if audio is not None:
+                        await async_play_audio(audio)
+                    elif speech := self.speech_text(ai_response):
+                        await async_play_voice(speech, self.speaker,
+                                               self.voice)
+                except (EOFError, wave.Error, OSError) as wav_e:
+                    # OSErrorはWeb APIの接続エラー(requests.RequestException)を含む
+                    print("Error: 音声再生中にエラーが発生しました。", f"{wav_e}無視してテキストを表示します。")
+        except asyncio.CancelledError:
+            print(f"{self.name}: {ai_response}")
+            raise
+        try:
+            await print_one_by_one(f"{self.name}: {ai_response}\n")
+        except asyncio.CancelledError:
+            print()
+            raise
 
 
 class Summarizer(AI):
@@ -369,13 +658,14 @@ class Summarizer(AI):
         - ドラマ鑑賞
         """  # 528 tokens
 
-    def __init__(self, name, filename, gist, chat_summary):
+    def __init__(self, name, filename, gist, chat_summary, provider=None):
         """
         * 親クラスから引き継がれるプロパティ
             * `name`
             * `filename`
             * `gist`
             * `chat_summary`
+            * `provider` 要約用のAPIの接続先
         * 子クラスで定義された定数を使用
             * `max_tokens`
             * `temperature`
@@ -387,31 +677,96 @@ class Summarizer(AI):
                          system_role=Summarizer.system_role,
                          filename=filename,
                          gist=gist,
-                         chat_summary=chat_summary)
+                         chat_summary=chat_summary,
+                         provider=provider)
+
+    reduce_role = """
+        The following are partial summaries of one long conversation, in order.
+        Merge them into a single summary without dropping any facts,
+        removing only duplicated items.
+        The merged summary should be no more than 2000 tokens.
+        Output it in exactly the same format as the partial summaries:
+        a "# Summary Content" list followed by a "# User Preference" list.
+    """
 
     async def post(self, messages: list[Message]) -> str:
         """Summarizer.post
         会話履歴と会話の内容を送信して会話の要約を作る。
         さらに、ユーザーの好みをリストアップする。
+        1回のリクエストに収まらなければ、token数で区切った塊ごとに並列に要約し(map)、
+        部分的な要約をまとめる(reduce)。どの行も切り捨てない。
         """
         chat_history: list[str] = [
             f"- {self.name}: {m.content}"
             if m.role == str(Role.ASSISTANT) else f"- User: {m.content}"
             for m in messages
         ]
+        # split_summary: summaryの改行区切り
         split_summary: list[str] = self.chat_summary.split("\n")
+        chunks = self.split_chunks(split_summary + chat_history,
+                                   Summarizer.system_role)
+        if len(chunks) == 1:
+            return await self.request(Summarizer.system_role, chunks[0])
+        partials = await self.map(Summarizer.system_role, chunks)
+        return await self.reduce(partials)
+
+    def split_chunks(self, lines: list[str], system_role: str) -> list[str]:
+        """system_roleと合わせてtoken上限に収まるように行をまとめる
+        1行で上限を超える行はtoken単位で分割する
+        """
+        enc = self.encoding()
+        budget = max(
+            self.provider.token_limit - self.max_tokens -
+            len(enc.encode(system_role)) - 16, 1)
+        chunks: list[str] = []
+        chunk: list[str] = []
+        size = 0
+        for line in lines:
+            tokens = enc.encode(line)
+            pieces = [
+                enc.decode(tokens[i:i + budget])
+                for i in range(0, len(tokens), budget)
+            ] or [line]
+            for piece in pieces:
+                piece_size = len(enc.encode(piece)) + 1  # 改行の分
+                if chunk and size + piece_size > budget:
+                    chunks.append("\n".join(chunk))
+                    chunk, size = [], 0
+                chunk.append(piece)
+                size += piece_size
+        if chunk:
+            chunks.append("\n".join(chunk))
+        return chunks or [""]
+
+    async def map(self, system_role: str, chunks: list[str]) -> list[str]:
+        """塊ごとにSUMMARIZE_CONCURRENCY件ずつ並列に要約する"""
+        semaphore = asyncio.Semaphore(SUMMARIZE_CONCURRENCY)
+
+        async def summarize_chunk(chunk: str) -> str:
+            async with semaphore:
+                return await self.request(system_role, chunk)
+
+        return list(await asyncio.gather(*map(summarize_chunk, chunks)))
+
+    async def reduce(self, partials: list[str]) -> str:
+        """部分的な要約を1つの要約へまとめる
+        1回のリクエストに収まらなければ、まとめた結果をさらにまとめる。
+        まとめてもtoken数が減らなければ、切り捨てずに部分的な要約をつなげて返す
+        """
         while True:
-            # split_summary: summaryの改行区切り
-            # system_role: Summarizerの役割
-            # content: 会話履歴
-            send_msg = [Summarizer.system_role] + split_summary + chat_history
-            # これら３つの要素を改行でつなげてトークン計算
-            # messagesが最大トークンに収まるまで続ける
-            if not self.is_over_limit('\n'.join(send_msg)):
-                break
-            # summaryの上から一行ずつ削除
-            split_summary.pop(0)
-        content: str = '\n'.join(split_summary + chat_history)
+            chunks = self.split_chunks(partials, Summarizer.reduce_role)
+            if len(chunks) == 1:
+                return await self.request(Summarizer.reduce_role, chunks[0])
+            reduced = await self.map(Summarizer.reduce_role, chunks)
+            if (self.token_length("\n".join(reduced)) >=
+                    self.token_length("\n".join(partials))):
+                return "\n".join(reduced)
+            partials = reduced
+
+    async def request(self, system_role: str, content: str) -> str:
+        """要約のリクエスト
+        429 Too Many Requestsが返ったら待ってから再試行する
+        """
         data = {
             "model":
             self.model,
@@ -421,71 +776,110 @@ class Summarizer(AI):
             Summarizer.temperature,
             "messages": [{
                 "role": str(Role.SYSTEM),
-                "content": Summarizer.system_role
+                "content": system_role
             }, {
                 "role": str(Role.USER),
                 "content": content
             }]
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(ENDPOINT,
-                                    headers=HEADERS,
-                                    data=json.dumps(data)) as response:
-                if response.status == 429:
-                    raise TooManyRequestsError("Too many requests")
-                elif response.status >= 400:
-                    raise ValueError('{}: {}'.format(response.status,
-                                                     response.json()))
-                ai_response = await response.json()
-        content = get_content(ai_response)
-        return content
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        for retry in range(MAX_RETRIES + 1):
+            try:
+                async with aiohttp.ClientSession(timeout=timeout) as session:
+                    async with session.post(
+                            self.provider.endpoint,
+                            headers=self.provider.headers(),
+                            data=json.dumps(data)) as response:
+                        if response.status == 429:
+                            retry_after = response.headers.get("Retry-After")
+                            raise TooManyRequestsError(
+                                "Too many requests",
+                                float(retry_after) if retry_after
+                                and retry_after.isdigit() else None)
+                        elif response.status >= 400:
+                            raise ValueError('{}: {}'.format(
+                                response.status, await response.text()))
+                        ai_response = await response.json()
+            except TooManyRequestsError as e:
+                if retry == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after or RETRY_WAIT * 2**retry)
+                continue
+            return get_content(ai_response)
 
 
 def ai_constructor(listen: bool = False,
-                   model: str = "gpt-3.5-turbo",
+                   model: Optional[str] = None,
                    name: str = "ChatGPT",
                    speaker=None,
                    voice: Mode = Mode.NONE,
-                   character_file: Optional[str] = None) -> AI:
+                   character_file: Optional[str] = None,
+                   speculate: int = 0,
+                   memory: Optional[str] = None,
+                   hedge: Optional[str] = None,
+                   hedge_percentile: Optional[float] = None,
+                   resume: bool = False) -> AI:
     """YAMLファイルから設定リストを読み込み、characterに指定されたAIキャラクタを返す
 
     Args:
+        model: ChatGPTモデル。NoneならYAMLのprovider.modelまたはgpt-3.5-turbo。
         character: 選択するAIキャラクタの名前。
         voice: AIの音声生成モード。
         speaker: AIの発話用テキスト読み上げキャラクター。
         character_file: ローカルのキャラ設定YAMLファイルのパス
+        speculate: 投機的生成に使うtoken数の上限。0で投機的生成しない。
+        memory: 長期記憶のストレージ(gist, sharded, sqlite)。
+            Noneならcharacter_fileが指定されていなければgist、
+            指定されていれば長期記憶を使わない。
+        hedge: 最初のtokenが遅いときに予備の要求を送るモデル。
+            空文字ならmodelと同じモデルへ送る。Noneで予備の要求を送らない。
+        hedge_percentile: 予備の要求を送る期限とする、
+            最初のtokenまでの時間の分位点。Noneならhedge.PERCENTILE。
+        resume: Trueでジャーナルから直近の会話履歴と要約を復元する。
+            復元した会話履歴はai.resumedに入る。
 
     Returns:
         選択されたAIキャラクタのインスタンス。
     """
-    if character_file:  # ローカルのキャラ設定YAMLファイルが指定されたとき
-        with open(character_file, "r", encoding="utf-8") as yaml_str:
-            config = yaml.safe_load(yaml_str)
-    else:  # キャラ設定YAMLファイルが指定されなければGist上のキャラ設定を読みに行く
-        from lib.gist_memory import Gist
-        gist = Gist(CONFIG_FILE)
-        yaml_str = gist.get()
-        config = yaml.safe_load(yaml_str)
-    if config is None:
-        raise ValueError("キャラクター設定ファイルが存在しません。")
-
-    # YAMLファイルから読んだカスタムAIのリストとデフォルトのAI
-    ais = [AI()] + [AI(**c) for c in config]
-
-    # name引数で指定されたnameのAIを選択
-    #  同名があったらYAMLファイルの下の行にあるものを優先する。
-    ai = [a for a in ais if a.name == name][-1]
+    from .character_catalog import CharacterCatalog
+    # YAMLファイルから読んだカスタムAIの設定とデフォルトのAIの設定を
+    # 名前で索引し、name引数で指定されたnameのAIだけを構築する
+    catalog = CharacterCatalog(character_file)
+    ai = catalog.build(name)
 
     # コマンドライン引数から設定を適用
     # YAMLの設定を上書きする
-    if not character_file:
+    if memory is None and not character_file:
+        memory = "gist"
+    from .journal import Journal
+    ai.journal = Journal(ai.filename)
+    if memory is not None:
+        from .memory import open_memory
+        ai.gist = open_memory(ai.filename, memory)
+    if resume:  # ジャーナルから会話履歴と要約を復元する
+        ai.resumed = ai.resume()
+    if ai.gist is not None and not (resume and ai.chat_summary):
         # 会話履歴を読み込む
-        ai.gist = Gist(ai.filename)
         ai.chat_summary = ai.gist.get()
     ai.listen = listen
-    ai.model = model
+    if model is not None:
+        ai.model = model
+        ai.model_fixed = True
+    if speaker is not None:
+        ai.speaker = ai.set_speaker(speaker)
+        ai.speaker_fixed = True
     # AIの音声生成モードを設定
     if isinstance(voice, int):
         voice = Mode(voice)
     ai.voice = voice
+    if speculate > 0:
+        from .speculation import Speculator
+        # 音声はLOCALのときだけ先に合成する
+        # Web APIは破棄した音声にもポイントを消費するため
+        ai.speculator = Speculator(ai, speculate, audio=voice == Mode.LOCAL)
+    if hedge is not None:
+        from .hedge import Hedger, PERCENTILE
+        ai.hedger = Hedger(fallback_model=hedge or None,
+                           percentile=PERCENTILE if hedge_percentile is None
+                           else hedge_percentile)
     return ai
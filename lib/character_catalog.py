@@ -0,0 +1,192 @@
+"""AIキャラクタ設定のカタログ
+YAMLを一度だけ解析してキャラクタ名で設定を索引し、
+選択されたAIだけをその場で構築する。
+設定ファイルの変更を検知して、会話を保ったまま設定を差し替える。
+
+# USAGE
+catalog = CharacterCatalog("character.yml")
+ai = catalog.build("ChatGPT")
+catalog.refresh(ai)  # YAMLが更新されていればaiへ反映
+"""
+import os
+import asyncio
+import inspect
+from time import monotonic
+from typing import Optional
+import yaml
+from .ai import AI, CONFIG_FILE
+from .provider import Provider
+from .tts_text import preprocess
+from .voicevox_character import CV
+
+# Gist上のキャラ設定を再検証する間隔(秒)
+REVALIDATE_INTERVAL = 60
+# 実行中に差し替えるキャラクタ設定のキー
+# filenameは長期記憶の保存先が変わるため差し替えない
+RELOADABLE_KEYS = ("max_tokens", "temperature", "system_role", "speaker",
+                   "history_budget", "keep_turns", "provider",
+                   "summary_provider", "tts")
+# キャラクタ設定、接続先、読み上げの前処理に指定できるキー
+AI_KEYS = frozenset(inspect.signature(AI).parameters)
+PROVIDER_KEYS = frozenset(inspect.signature(Provider).parameters)
+TTS_KEYS = frozenset(inspect.signature(preprocess).parameters) - {"text"}
+
+
+def validate(config: dict):
+    """AIを構築せずにキャラクタ設定の辞書を検証する
+    不正なキーや値があればValueErrorを送出する
+    """
+    if not isinstance(config, dict):
+        raise ValueError(f"キャラクタの設定が辞書ではありません: {config}")
+    unknown = config.keys() - AI_KEYS
+    if unknown:
+        raise ValueError(f"不明なキー{sorted(unknown)}が指定されています。")
+    speaker = config.get("speaker")
+    if speaker is not None:
+        try:
+            CV(int(speaker))
+        except ValueError:
+            if speaker not in CV.__members__:
+                raise ValueError(f"speaker {speaker}が見つかりません。") from None
+    for key, allowed in (("provider", PROVIDER_KEYS),
+                         ("summary_provider", PROVIDER_KEYS),
+                         ("tts", TTS_KEYS)):
+        value = config.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, dict):
+            raise ValueError(f"{key}は辞書で指定してください: {value}")
+        unknown = value.keys() - allowed
+        if unknown:
+            raise ValueError(f"{key}に不明なキー{sorted(unknown)}が指定されています。")
+
+
+class CharacterCatalog:
+    """キャラクタ名で索引したAI設定の辞書
+
+    character_fileが指定されればローカルのYAMLファイルの更新時刻を監視し、
+    指定されなければGist上のキャラ設定をREVALIDATE_INTERVAL秒ごとに再検証する。
+    Gistの再検証はETagによる条件付きGETを別スレッドで行い、
+    GitHubの応答が遅くても会話を止めない。
+    """
+
+    def __init__(self, character_file: Optional[str] = None):
+        self.character_file = character_file
+        self.configs: dict[str, dict] = {}
+        self._stamp = None  # 前回読み込み時のmtimeまたはYAML文字列
+        self._checked = monotonic()  # 前回Gistを検証した時刻
+        self._etag = None  # 前回取得したGistのETag
+        self._pending: Optional[asyncio.Future] = None  # 検証中のGistの読み込み
+        self.load()
+
+    def _read(self):
+        """設定の読み込み元から(stamp, YAML文字列)を返す
+        変更がなければYAML文字列はNone
+        """
+        if self.character_file:  # ローカルのキャラ設定YAMLファイル
+            stamp = os.stat(self.character_file).st_mtime_ns
+            if stamp == self._stamp:
+                return stamp, None
+            with open(self.character_file, "r", encoding="utf-8") as f:
+                return stamp, f.read()
+        # キャラ設定YAMLファイルが指定されなければGist上のキャラ設定を読みに行く
+        # Gistが更新されていなければ(304 Not Modified)ファイルを取得しない
+        from lib.gist_memory import Gist, read_file
+        headers = {"If-None-Match": self._etag} if self._etag else {}
+        resp = Gist.request("GET", headers=headers)
+        if resp.status_code == 304:
+            return self._stamp, None
+        self._etag = resp.headers.get("ETag")
+        yaml_str = read_file(resp.json()["files"][CONFIG_FILE])
+        if yaml_str == self._stamp:
+            return yaml_str, None
+        return yaml_str, yaml_str
+
+    def load(self) -> bool:
+        """YAMLを解析して設定を名前で索引する
+        同名があったらYAMLファイルの下の行にあるものを優先する。
+        Return: 設定が更新されたらTrue
+        """
+        stamp, yaml_str = self._read()
+        if yaml_str is None:
+            return False
+        config = yaml.safe_load(yaml_str)
+        if config is None:
+            raise ValueError("キャラクター設定ファイルが存在しません。")
+        if not isinstance(config, list):
+            raise ValueError("キャラクター設定はキャラクタごとの設定のリストで記述してください。")
+        # デフォルトのAIとYAMLファイルから読んだカスタムAI
+        # 不正なキーや値の設定は読み込み時に弾き、差し替え時に落ちないようにする
+        default_name = inspect.signature(AI).parameters["name"].default
+        configs: dict[str, dict] = {default_name: {}}
+        for c in config:
+            validate(c)
+            configs[c.get("name", default_name)] = c
+        self.configs = configs
+        self._stamp = stamp
+        return True
+
+    def names(self) -> list[str]:
+        """登録されたキャラクタ名の一覧"""
+        return list(self.configs)
+
+    def get(self, name: str) -> dict:
+        """nameで指定されたキャラクタの設定"""
+        try:
+            return self.configs[name]
+        except KeyError as k_e:
+            raise KeyError(f"キャラクタ{name}が見つかりません。"
+                           f"選択可能なキャラクタ: {self.names()}") from k_e
+
+    def build(self, name: str) -> AI:
+        """nameで指定されたキャラクタのAIだけを構築する"""
+        ai = AI(**self.get(name))
+        ai.catalog = self
+        return ai
+
+    def changed(self) -> bool:
+        """前回の読み込みから設定が変わっていればTrue
+        Gistは問い合わせ過多にならないようREVALIDATE_INTERVAL秒ごとに
+        別スレッドで検証を始め、検証が終わった後の呼び出しで結果を返す
+        """
+        try:
+            if self.character_file:
+                return self.load()
+            if self._pending is not None:
+                if not self._pending.done():
+                    return False
+                pending, self._pending = self._pending, None
+                return pending.result()
+            now = monotonic()
+            if now - self._checked >= REVALIDATE_INTERVAL:
+                self._checked = now
+                loop = asyncio.get_running_loop()
+                self._pending = loop.run_in_executor(None, self.load)
+            return False
+        except (OSError, KeyError, ValueError, yaml.YAMLError) as e:
+            # 編集途中の壊れたYAMLは無視して現在の設定を使い続ける
+            print(f"Warning: キャラクター設定の再読み込みに失敗しました。{e}")
+            return False
+
+    def refresh(self, ai: AI) -> bool:
+        """設定ファイルが更新されていれば、aiへキャラクタ設定を反映する
+        会話履歴と要約(chat_summary)、コマンドライン引数の設定は保持する
+        """
+        if not self.changed():
+            return False
+        config = self.configs.get(ai.name)
+        if config is None:  # 実行中のキャラクタが設定から消えたら現状維持
+            return False
+        try:
+            fresh = AI(**config)
+        except (TypeError, KeyError, ValueError, AttributeError) as e:
+            print(f"Warning: キャラクター設定の反映に失敗しました。{e}")
+            return False
+        for key in RELOADABLE_KEYS:
+            if key == "speaker" and ai.speaker_fixed:
+                continue
+            setattr(ai, key, getattr(fresh, key))
+        # 接続先が変わればモデルも接続先の指定に従う
+        if not ai.model_fixed:
+            ai.model = fresh.model
+        return True
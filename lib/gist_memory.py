@@ -8,13 +8,42 @@ print(content)
 
 content = gist.patch("明日も晴れ")
 print(content)
+
+# 分割保存
+gist = ShardedGist("chatgpt-assistant.txt")
+gist.patch("明日も晴れ")  # chatgpt-assistant.txt に分割ファイルの一覧
+                         # chatgpt-assistant.000.txt ... に内容を保存
 """
 import os
 import json
 import requests
+from .memory import Memory, MEMORY_DB
+
+# 分割保存する1ファイルあたりの最大バイト数
+# GitHubはAPIレスポンスで1MBを超えるファイルの内容を切り詰める
+SHARD_SIZE = 256 * 1024
+# Gistのファイル一覧とETagのキャッシュ
+GIST_CACHE = os.path.join(os.path.dirname(MEMORY_DB), "gist_cache.json")
+
+
+def get_raw(raw_url) -> str:
+    """raw_urlからファイルの内容をストリーミングで取得"""
+    with requests.get(raw_url, stream=True) as resp:
+        resp.raise_for_status()
+        chunks = resp.iter_content(chunk_size=64 * 1024)
+        return b"".join(chunks).decode("utf-8")
+
 
+def read_file(file: dict) -> str:
+    """Gist APIのfilesの要素から内容を取得
+    切り詰められた大きなファイルはraw_urlから取得し直す
+    """
+    if file.get("truncated") or file.get("content") is None:
+        return get_raw(file["raw_url"])
+    return file["content"]
 
-class Gist:
+
+class Gist(Memory):
     """gist API handler"""
     __id = os.environ["GIST_ID"]
     __url = "https://api.github.com/gists/" + __id
@@ -24,7 +53,7 @@ class Gist:
 
     def __init__(self, filename):
         """指定したgist ファイルに対するAPI操作"""
-        self.filename = filename
+        super().__init__(filename)
 
     @classmethod
     def set_params(cls):
@@ -48,23 +77,148 @@ class Gist:
             }
         return None
 
-    def get(self):
-        """Gist上の指定ファイルの内容を取得"""
-        resp = requests.get(Gist.__url, params=Gist.set_params())
+    @classmethod
+    def request(cls, method, headers=None, **kwargs) -> requests.Response:
+        """Gist APIへのリクエスト"""
+        resp = requests.request(method,
+                                Gist.__url,
+                                headers=headers,
+                                params=Gist.set_params(),
+                                **kwargs)
         resp.raise_for_status()
-        content = resp.json()["files"][self.filename]["content"]
-        return content
+        return resp
 
-    def patch(self, body):
-        """bodyの内容をGistへ保存"""
-        headers = {
+    @classmethod
+    def auth_headers(cls) -> dict:
+        """Gistへ書き込むためのヘッダー"""
+        return {
             "Accept": "application/vnd.github+json",
             "Authorization": f"token {Gist.__token}"
         }
+
+    def get(self):
+        """Gist上の指定ファイルの内容を取得"""
+        resp = Gist.request("GET")
+        return read_file(resp.json()["files"][self.filename])
+
+    def patch(self, body):
+        """bodyの内容をGistへ保存"""
         data = {"files": {self.filename: {"content": body}}}
-        resp = requests.patch(Gist.__url,
-                              headers=headers,
-                              params=Gist.set_params(),
-                              data=json.dumps(data))
-        resp.raise_for_status()
-        return resp.json()["files"][self.filename]["content"]
+        resp = Gist.request("PATCH",
+                            headers=Gist.auth_headers(),
+                            data=json.dumps(data))
+        return read_file(resp.json()["files"][self.filename])
+
+
+class ShardedGist(Gist):
+    """大きな記憶をGist上の複数ファイルへ分割して保存する
+
+    filenameには分割ファイル名の一覧をJSONで保存し、
+    内容は{stem}.000{ext}, {stem}.001{ext}, ... へ分割して保存する。
+    filenameが分割前の形式であればその内容をそのまま記憶とする。
+
+    Gistのファイル一覧はETagとともにローカルへキャッシュし、
+    Gistが更新されていなければ(304 Not Modified)
+    必要な分割ファイルだけをraw_urlから取得する。
+    保存時は内容が変わった分割ファイルだけを送信する。
+    """
+
+    def __init__(self, filename, cache_file: str = GIST_CACHE):
+        super().__init__(filename)
+        self.cache_file = cache_file
+        self.shards: dict[str, str] = {}  # 前回読み書きした分割ファイルの内容
+
+    def shard_name(self, index: int) -> str:
+        """index番目の分割ファイル名"""
+        stem, ext = os.path.splitext(self.filename)
+        return f"{stem}.{index:03d}{ext}"
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, etag, files: dict):
+        """ファイル一覧から内容を除いてETagとともにキャッシュする"""
+        cache = {
+            "etag": etag,
+            "files": {
+                name: {
+                    "raw_url": f["raw_url"],
+                    "truncated": True
+                }
+                for name, f in files.items()
+            }
+        }
+        os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+        with open(self.cache_file, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+
+    def _files(self) -> dict:
+        """Gistのファイル一覧
+        キャッシュが最新であれば内容を含まず、raw_urlから取得する
+        """
+        cache = self._load_cache()
+        headers = {}
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        resp = Gist.request("GET", headers=headers)
+        if resp.status_code == 304:
+            return cache["files"]
+        files = resp.json()["files"]
+        self._save_cache(resp.headers.get("ETag"), files)
+        return files
+
+    def get(self):
+        """Gist上の分割ファイルを結合して内容を取得"""
+        files = self._files()
+        index = read_file(files[self.filename])
+        try:
+            names = json.loads(index)["shards"]
+        except (ValueError, KeyError, TypeError):  # 分割前の形式
+            return index
+        self.shards = {name: read_file(files[name]) for name in names}
+        return "".join(self.shards[name] for name in names)
+
+    def split(self, body: str) -> dict[str, str]:
+        """bodyを行単位でSHARD_SIZEバイト以下の分割ファイルへ分ける"""
+        shards: list[str] = []
+        chunk, size = [], 0
+        for line in body.splitlines(keepends=True):
+            line_size = len(line.encode("utf-8"))
+            if chunk and size + line_size > SHARD_SIZE:
+                shards.append("".join(chunk))
+                chunk, size = [], 0
+            chunk.append(line)
+            size += line_size
+        if chunk:
+            shards.append("".join(chunk))
+        return {self.shard_name(i): s for i, s in enumerate(shards)}
+
+    def patch(self, body):
+        """bodyを分割してGistへ保存
+        内容が変わった分割ファイルと分割ファイル一覧だけを送信し、
+        使われなくなった分割ファイルは削除する
+        """
+        shards = self.split(body)
+        files: dict = {
+            name: {
+                "content": content
+            }
+            for name, content in shards.items()
+            if self.shards.get(name) != content
+        }
+        for name in self.shards.keys() - shards.keys():
+            files[name] = None  # Gistではnullを送るとファイルが削除される
+        files[self.filename] = {
+            "content": json.dumps({"shards": list(shards)})
+        }
+        resp = Gist.request("PATCH",
+                            headers=Gist.auth_headers(),
+                            data=json.dumps({"files": files}))
+        self.shards = shards
+        # PATCHのレスポンスは更新後のGistなので、そのETagとraw_urlでキャッシュし直す
+        self._save_cache(resp.headers.get("ETag"), resp.json()["files"])
+        return body
@@ -0,0 +1,115 @@
+"""応答が遅いときの予備の要求(hedged request)
+最初のtokenが期限までに届かなければ、同じ内容の要求を
+(指定があれば応答の速い予備のモデルへ)もう1つ送り、
+先に最初のtokenを返した方の回答を使って、もう一方を取り消す。
+期限はモデルごとに観測した最初のtokenまでの時間の分位点から決める。
+
+# USAGE
+ai.hedger = Hedger(fallback_model="gpt-3.5-turbo")
+"""
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Optional
+
+# 期限に使う最初のtokenまでの時間の分位点
+PERCENTILE = 0.95
+# 観測数がこれより少ないうちはDEFAULT_DEADLINEを期限とする
+MIN_SAMPLES = 5
+# 観測が少ないうちの期限(秒)
+DEFAULT_DEADLINE = 5.0
+# 期限の下限(秒)
+MIN_DEADLINE = 0.5
+# モデルごとに保持する観測数
+WINDOW = 100
+
+
+class Hedger:
+    """最初のtokenまでの時間をモデルごとに観測し、
+    期限を過ぎたら予備の要求を送る
+    """
+
+    def __init__(self,
+                 fallback_model: Optional[str] = None,
+                 percentile: float = PERCENTILE):
+        if not 0 < percentile <= 1:
+            raise ValueError(f"percentileは0より大きく1以下で指定してください: {percentile}")
+        self.fallback_model = fallback_model
+        self.percentile = percentile
+        self.latency: dict[str, deque] = {}  # モデルごとの最初のtokenまでの時間
+
+    def record(self, model: str, seconds: float):
+        """最初のtokenまでの時間の観測"""
+        self.latency.setdefault(model, deque(maxlen=WINDOW)).append(seconds)
+
+    def deadline(self, model: str) -> float:
+        """予備の要求を送るまでの期限(秒)"""
+        samples = sorted(self.latency.get(model, ()))
+        if len(samples) < MIN_SAMPLES:
+            return DEFAULT_DEADLINE
+        index = min(int(len(samples) * self.percentile), len(samples) - 1)
+        return max(samples[index], MIN_DEADLINE)
+
+    async def _timed(self, ai, data: dict, chunks: list[str],
+                     first: asyncio.Future) -> str:
+        """最初のtokenまでの時間を観測しながら回答を受け取る
+        最初にtokenを返した要求はfirstに自身のtaskを設定する
+        """
+        model = data["model"]
+        task = asyncio.current_task()
+        start = monotonic()
+
+        def on_first():
+            self.record(model, monotonic() - start)
+            if not first.done():
+                first.set_result(task)
+
+        try:
+            return await ai.stream(data, chunks, on_first)
+        except asyncio.CancelledError:
+            if not chunks:  # 最初のtokenが来る前に取り消されたら少なくともこれだけかかる
+                self.record(model, monotonic() - start)
+            raise
+
+    async def run(self, ai, data: dict, partial: list[str]) -> str:
+        """dataをAPIへ送り、期限までに最初のtokenが届かなければ予備の要求を送る
+        先に最初のtokenを返した方の回答をpartialへ入れて返す
+        """
+        loop = asyncio.get_running_loop()
+        first = loop.create_future()  # 最初にtokenを返した要求のtask
+        racers: dict[asyncio.Task, list[str]] = {}
+
+        def start(model: str):
+            chunks: list[str] = []
+            task = asyncio.create_task(
+                self._timed(ai, {
+                    **data, "model": model
+                }, chunks, first))
+            racers[task] = chunks
+
+        start(data["model"])
+        deadline = loop.time() + self.deadline(data["model"])
+        winner = None
+        try:
+            while winner is None:
+                pending = {t for t in racers if not t.done()}
+                timeout = None
+                if len(racers) == 1:  # まだ予備の要求を送っていない
+                    timeout = max(deadline - loop.time(), 0)
+                done, _ = await asyncio.wait(pending | {first},
+                                             timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if first.done():
+                    winner = first.result()
+                elif not done:  # 期限切れ
+                    start(self.fallback_model or data["model"])
+                elif all(t.done() for t in racers):
+                    # どの要求もtokenを返さずに終わった(エラーまたは空の回答)
+                    winner = done.pop()
+            return await winner
+        finally:
+            for task in racers:
+                if task is not winner:
+                    task.cancel()
+            if winner is not None:
+                partial[:] = racers[winner]
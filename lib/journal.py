@@ -0,0 +1,175 @@
+"""会話の追記専用ジャーナル
+会話と要約を1件ずつローカルのファイルへ追記し、
+終了やクラッシュの後でも直近の会話履歴と未保存の要約を復元できるようにする。
+
+レコードの形式は 長さ(4byte) + JSON + 長さ(4byte)。
+末尾にも長さを書くので、ファイルの末尾から逆向きに読んで
+全体を走査せずに直近のレコードだけを取り出せる。
+
+# USAGE
+journal = Journal("chatgpt-assistant.txt")
+journal.append({"type": "message", "role": "user", "content": "こんにちは"})
+messages, summary, unsaved = journal.tail(50)
+"""
+import os
+import json
+import asyncio
+import hashlib
+import atexit
+import struct
+from time import monotonic
+from typing import Optional
+from .memory import MEMORY_DB
+
+# ジャーナルを保存するディレクトリ
+JOURNAL_DIR = os.path.join(os.path.dirname(MEMORY_DB), "journal")
+# この件数を追記するごとにfsyncする
+FSYNC_BATCH = 16
+# 前回のfsyncからこの秒数が経っていれば追記時にfsyncする
+FSYNC_INTERVAL = 1.0
+# --resumeで復元する会話の最大件数
+RESUME_MESSAGES = 50
+
+LENGTH = struct.Struct(">I")
+
+
+def summary_id(content: str) -> str:
+    """要約のレコードと保存済みのレコードを対応づけるid"""
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+class Journal:
+    """filenameごとの追記専用ジャーナル
+
+    記録するレコード
+        {"type": "message", "role": ..., "content": ...}: 会話
+        {"type": "summary", "id": ..., "content": ...}: 作成した要約
+        {"type": "saved", "id": ...}: idの要約を長期記憶へ保存済み
+    idは要約の内容のハッシュ(summary_id)。
+    要約の保存は並行して完了することがあるので、どの要約の保存かをidで対応づける
+    """
+
+    def __init__(self, filename, directory: str = JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{filename}.journal")
+        self.file = None
+        self.pending = 0  # fsyncしていないレコード数
+        self.synced = monotonic()  # 前回fsyncした時刻
+        self.timer: Optional[asyncio.TimerHandle] = None  # 予約したfsync
+
+    def _open(self):
+        """追記用に開く。クラッシュで書きかけになった末尾のレコードは切り捨てる"""
+        if self.file is not None:
+            return
+        self.file = open(self.path, "ab")
+        end = self._valid_end()
+        if end < self.file.tell():
+            self.file.truncate(end)
+            self.file.seek(end)
+        atexit.register(self.close)
+
+    def _valid_end(self) -> int:
+        """正しく書き終えた最後のレコードの終端位置"""
+        with open(self.path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            if self._record_before(f, size) is not None or size == 0:
+                return size
+            # 末尾が壊れているときだけ先頭から走査する
+            end = 0
+            f.seek(0)
+            while header := f.read(LENGTH.size):
+                if len(header) < LENGTH.size:
+                    break
+                n, = LENGTH.unpack(header)
+                body = f.read(n + LENGTH.size)
+                if len(body) < n + LENGTH.size or body[n:] != header:
+                    break
+                end = f.tell()
+            return end
+
+    @staticmethod
+    def _record_before(f, pos: int) -> Optional[tuple[int, dict]]:
+        """posで終わるレコードの(開始位置, 内容)。壊れていればNone"""
+        if pos < 2 * LENGTH.size:
+            return None
+        f.seek(pos - LENGTH.size)
+        n, = LENGTH.unpack(f.read(LENGTH.size))
+        start = pos - n - 2 * LENGTH.size
+        if start < 0:
+            return None
+        f.seek(start)
+        if LENGTH.unpack(f.read(LENGTH.size))[0] != n:
+            return None
+        try:
+            return start, json.loads(f.read(n).decode("utf-8"))
+        except ValueError:
+            return None
+
+    def append(self, record: dict):
+        """レコードを追記する
+        FSYNC_BATCH件ごと、またはFSYNC_INTERVAL秒ごとにまとめてfsyncする
+        続けて追記されなくても、イベントループ上ではFSYNC_INTERVAL秒後に
+        fsyncを予約して、入力待ちの間に未保存のまま残らないようにする
+        """
+        self._open()
+        payload = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        header = LENGTH.pack(len(payload))
+        self.file.write(header + payload + header)
+        self.file.flush()
+        self.pending += 1
+        if (self.pending >= FSYNC_BATCH
+                or monotonic() - self.synced >= FSYNC_INTERVAL):
+            self.sync()
+        elif self.timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # イベントループの外では終了時のclose()でfsyncする
+                return
+            self.timer = loop.call_later(FSYNC_INTERVAL, self.sync)
+
+    def sync(self):
+        """追記したレコードをディスクへ書き込む"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.file is None or self.pending == 0:
+            return
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.synced = monotonic()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.sync()
+        self.file.close()
+        self.file = None
+
+    def tail(self, max_messages: int = RESUME_MESSAGES):
+        """ファイルの末尾から逆向きに読み、
+        (直近の会話のレコード, 最新の要約, 最新の要約が未保存か)を返す
+        読むのは末尾からmax_messagesの4倍のレコードまで
+        """
+        messages: list[dict] = []
+        summary: Optional[str] = None
+        saved_ids: set = set()  # 最新の要約より後に保存済みとなった要約のid
+        saved = False
+        self._open()  # 書きかけのレコードを切り捨てる
+        with open(self.path, "rb") as f:
+            pos = f.seek(0, os.SEEK_END)
+            for _ in range(4 * max_messages):
+                if len(messages) >= max_messages and summary is not None:
+                    break
+                record = self._record_before(f, pos)
+                if record is None:
+                    break
+                pos, body = record
+                if body["type"] == "message" and len(messages) < max_messages:
+                    messages.append(body)
+                elif body["type"] == "saved" and summary is None:
+                    saved_ids.add(body.get("id"))
+                elif body["type"] == "summary" and summary is None:
+                    summary = body["content"]
+                    saved = body.get("id") in saved_ids
+        messages.reverse()
+        return messages, summary, summary is not None and not saved
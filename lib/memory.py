@@ -0,0 +1,95 @@
+"""会話の要約を長期記憶として保存するストレージ
+
+# USAGE
+memory = open_memory("chatgpt-assistant.txt", "sqlite")
+
+content = memory.get()
+print(content)
+
+content = memory.patch("明日も晴れ")
+print(content)
+"""
+import os
+import sqlite3
+from typing import Optional
+
+# 長期記憶のストレージの種類
+BACKENDS = ("gist", "sharded", "sqlite")
+# ローカルの長期記憶のデータベースファイル
+MEMORY_DB = os.getenv("CHATME_MEMORY_DB",
+                      os.path.expanduser("~/.chatme/memory.sqlite3"))
+
+
+class Memory:
+    """長期記憶のストレージのインターフェース
+    filenameごとに要約文を1つ保存する
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get(self) -> str:
+        """保存された要約文を取得"""
+        raise NotImplementedError
+
+    def patch(self, body: str) -> str:
+        """bodyの内容を保存"""
+        raise NotImplementedError
+
+
+class SQLiteMemory(Memory):
+    """ローカルのSQLiteファイルに保存する長期記憶
+    オフラインで使え、他のキャラクタの記憶を読み込まない
+    """
+
+    def __init__(self, filename, path: str = MEMORY_DB):
+        super().__init__(filename)
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        con = sqlite3.connect(self.path)
+        con.execute("""CREATE TABLE IF NOT EXISTS memory (
+                       filename TEXT PRIMARY KEY,
+                       content TEXT NOT NULL,
+                       updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        return con
+
+    def get(self) -> str:
+        """保存された要約文を取得
+        まだ保存されていなければ空文字を返す
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT content FROM memory WHERE filename = ?",
+                              (self.filename, )).fetchone()
+        con.close()
+        return "" if row is None else row[0]
+
+    def patch(self, body: str) -> str:
+        """bodyの内容を保存"""
+        with self._connect() as con:
+            con.execute(
+                """INSERT INTO memory (filename, content) VALUES (?, ?)
+                   ON CONFLICT(filename) DO UPDATE
+                   SET content = excluded.content,
+                       updated = CURRENT_TIMESTAMP""", (self.filename, body))
+        con.close()
+        return body
+
+
+def open_memory(filename, backend: Optional[str] = "gist") -> Memory:
+    """backendに指定されたストレージでfilenameの長期記憶を開く
+    gist: Gist上の1ファイル
+    sharded: Gist上の複数ファイルへ分割
+    sqlite: ローカルのSQLiteファイル
+    """
+    if backend == "sqlite":
+        return SQLiteMemory(filename)
+    if backend == "sharded":
+        from .gist_memory import ShardedGist
+        return ShardedGist(filename)
+    if backend == "gist":
+        from .gist_memory import Gist
+        return Gist(filename)
+    raise ValueError(f"error: memory backend is {backend}, "
+                     f"backend must be one of {BACKENDS}")
@@ -14,54 +14,139 @@ pip install pyaudio SpeechRecognition
 
 """
 import asyncio
+import threading
+from typing import Optional
 import speech_recognition as sr
+from .vad import rms, speech_segments
 
+# 発話とみなす音量の周囲雑音に対する倍率
+# スピーカーから出るAIの音声を拾わないよう高めに設定する
+BARGE_IN_RATIO = 3.0
+# 発話とみなす継続時間(秒)
+BARGE_IN_DURATION = 0.3
+# 音声認識へ送る音声のサンプリングレート
+RECOGNIZE_RATE = 16000
+# 発話の開始を待つ時間(秒)。この間隔で録音をやめるかを確認する
+LISTEN_TIMEOUT = 1.0
 
-async def async_mic_input(language="ja-JP") -> str:
+
+def trim_audio(audio: sr.AudioData, threshold: float) -> list[sr.AudioData]:
+    """録音から前後の無音を取り除き、長い発話を分割して、
+    RECOGNIZE_RATEへダウンサンプリングした発話区間のリストを返す
+    発話を含まなければ空のリストを返す
+    """
+    rate = min(audio.sample_rate, RECOGNIZE_RATE)
+    pcm = audio.get_raw_data(convert_rate=rate, convert_width=2)
+    return [
+        sr.AudioData(pcm[start:end], rate, 2)
+        for start, end in speech_segments(pcm, rate, threshold)
+    ]
+
+
+async def recognize(recognizer: sr.Recognizer,
+                    audio: sr.AudioData,
+                    language="ja-JP") -> str:
+    """発話区間の音声認識
+    認識できなければ空文字を返す
     """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, recognizer.recognize_google,
+                                          audio, None, language)
     except sr.UnknownValueError:
         print("Google Speech Recognition could not understand audio")
     except sr.RequestError as e:
         print(
             f"Could not request results from Google Speech Recognition service;{e}"
         )
+    return ""
+
+
+def listen_speech(stop: threading.Event,
+                  energy_threshold: Optional[float] = None):
+    """マイクから発話を含む録音を待ち、(発話区間のリスト, 音量の閾値)を返す
+    マイクの開閉はこの関数を呼んだスレッドの中で行う。
+    LISTEN_TIMEOUT秒ごとにstopを確認し、セットされたら録音をやめて空のリストを返す
+    energy_threshold: 前回の閾値。Noneなら周囲の雑音から求める
     """
     recognizer = sr.Recognizer()
     with sr.Microphone() as source:
-        recognizer.adjust_for_ambient_noise(source)
-        # listen for audio and convert it to text
-        audio = recognizer.listen(source)
-        loop = asyncio.get_running_loop()
-        while True:
+        if energy_threshold is None:
+            recognizer.adjust_for_ambient_noise(source)
+        else:
+            recognizer.energy_threshold = energy_threshold
+        while not stop.is_set():
             try:
-                text = await loop.run_in_executor(None,
-                                                  recognizer.recognize_google,
-                                                  audio, None, language)
-            except sr.UnknownValueError:
-                print("Google Speech Recognition could not understand audio")
-                continue
-            except sr.RequestError as e:
-                print(
-                    f"Could not request results from Google Speech Recognition service;{e}"
-                )
+                audio = recognizer.listen(source, timeout=LISTEN_TIMEOUT)
+            except sr.WaitTimeoutError:  # 発話が始まらなければstopを確認し直す
                 continue
+            segments = trim_audio(audio, recognizer.energy_threshold)
+            if segments:  # 発話がなければ認識せずに録音し直す
+                return segments, recognizer.energy_threshold
+    return [], recognizer.energy_threshold
+
+
+async def async_mic_input(language="ja-JP") -> str:
+    """
+    マイクから録音した音声を発話区間に分けて並列に音声認識する。
+    発話を含まない録音は認識へ送らず、
+    認識できなかったときは同じ音声を送り直さずに録音し直す。
+    録音は別スレッドで行い、キャンセルされたらそのスレッドにマイクを閉じさせる。
+    """
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    recognizer = sr.Recognizer()
+    threshold = None
+    try:
+        while True:
+            # listen for audio and convert it to text
+            future = loop.run_in_executor(None, listen_speech, stop, threshold)
+            segments, threshold = await asyncio.shield(future)
+            texts = await asyncio.gather(
+                *(recognize(recognizer, seg, language) for seg in segments))
+            text = "".join(texts)
             if text.strip():
                 break
-            # text = recognizer.recognize_google(audio, language=language)
-            # yield data
-        print(text)
-        return text
-
-    # recognize speech using Google Speech Recognition
-    # try:
-    #     text = recognizer.recognize_google(audio, language=language)
-    #     return text
-    # except sr.UnknownValueError:
-    #     print("Google Speech Recognition could not understand audio")
-    # except sr.RequestError as e:
-    #     print(
-    #         f"Could not request results from Google Speech Recognition service;{e}"
-    #     )
+    except asyncio.CancelledError:
+        stop.set()
+        raise
+    print(text)
+    return text
+
+
+def detect_speech(stop: threading.Event) -> bool:
+    """マイクからユーザーの発話を検知したらTrueを返す
+    stopがセットされたら検知をやめてFalseを返す
+    """
+    recognizer = sr.Recognizer()
+    with sr.Microphone() as source:
+        recognizer.adjust_for_ambient_noise(source, duration=0.5)
+        threshold = recognizer.energy_threshold * BARGE_IN_RATIO
+        seconds_per_buffer = source.CHUNK / source.SAMPLE_RATE
+        voiced = 0.0  # 閾値を超える音量が続いている時間
+        while not stop.is_set():
+            buffer = source.stream.read(source.CHUNK)
+            if rms(buffer) > threshold:
+                voiced += seconds_per_buffer
+            else:
+                voiced = 0.0
+            if voiced >= BARGE_IN_DURATION:
+                return True
+    return False
+
+
+async def async_detect_speech() -> bool:
+    """ユーザーの発話(barge-in)を非同期に待つ
+    キャンセルされたらマイクを閉じて検知をやめる
+    """
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, detect_speech, stop)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        stop.set()
+        raise
 
 
 if __name__ == "__main__":
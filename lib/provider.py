@@ -0,0 +1,79 @@
+"""OpenAI互換のChat Completions APIの接続先
+OpenAI APIのほか、localhost上のOpenAI互換の推論サーバーへも接続できる。
+キャラクタ設定YAMLで会話用(provider)と要約用(summary_provider)を別々に指定する。
+
+- name: "ChatGPT"
+  provider:
+    base_url: "https://api.openai.com/v1"
+    api_key_env: "CHATGPT_API_KEY"
+  summary_provider:
+    base_url: "http://localhost:8080/v1"
+    model: "llama-3-8b-instruct"
+    token_limit: 8192
+"""
+import os
+from typing import Optional, Union
+from urllib.parse import urlparse
+
+# OpenAI APIのURL
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+# APIキーを読み込む環境変数
+API_KEY_ENV = "CHATGPT_API_KEY"
+# modelのAPI token上限
+TOKEN_LIMIT = 4096
+# 認証なしで接続できるホスト
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class Provider:
+    """Chat Completions APIの接続先
+
+    base_url: APIのURL。/chat/completionsを付けてPOSTする
+    api_key: APIキー。Noneなら最初の使用時に環境変数api_key_envから読む
+    api_key_env: APIキーを読み込む環境変数
+    model: 使用するモデル。Noneなら呼び出し側のモデル
+    token_limit: modelのAPI token上限
+    """
+
+    def __init__(self,
+                 base_url: str = OPENAI_BASE_URL,
+                 api_key: Optional[str] = None,
+                 api_key_env: str = API_KEY_ENV,
+                 model: Optional[str] = None,
+                 token_limit: int = TOKEN_LIMIT):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.api_key_env = api_key_env
+        self.model = model
+        self.token_limit = token_limit
+
+    @property
+    def endpoint(self) -> str:
+        """Chat Completions APIのURL"""
+        return f"{self.base_url}/chat/completions"
+
+    def is_local(self) -> bool:
+        """localhost上の推論サーバーか"""
+        return urlparse(self.base_url).hostname in LOCAL_HOSTS
+
+    def headers(self) -> dict:
+        """APIのheader
+        APIキーは最初の使用時に環境変数から読み込む。
+        localhost上の推論サーバーはAPIキーがなければ認証なしで接続する。
+        """
+        headers = {"Content-Type": "application/json"}
+        if self.api_key is None:
+            self.api_key = os.getenv(self.api_key_env)
+        if self.api_key is None:
+            if self.is_local():
+                return headers
+            raise KeyError(f"環境変数{self.api_key_env}にAPIキーを設定してください。")
+        headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    @classmethod
+    def from_config(cls, config: Union[None, dict, "Provider"]) -> "Provider":
+        """YAMLの設定(辞書)から接続先を作る。Noneならデフォルトの接続先"""
+        if isinstance(config, Provider):
+            return config
+        return cls(**(config or {}))
@@ -0,0 +1,110 @@
+"""質問待受タイムアウト時の回答の投機的生成
+入力待ちの間に、タイムアウトしたときに送る質問(続けて、他の話題は？ など)への
+回答を先に考えておく。
+タイムアウトすれば生成済みの回答をすぐに使い、ユーザーが入力すれば破棄する。
+
+# USAGE
+speculator = Speculator(ai, budget=10000)
+speculator.start(chat_messages, "続けて")
+...
+speculated = await speculator.take(user_input)
+if speculated is not None:
+    response_messages, audio = speculated
+"""
+import asyncio
+from typing import Optional
+from .ai import AI, Message, Role, TIMEOUT
+
+# タイムアウトの何秒前から投機的生成を始めるか
+# ユーザーがすぐに入力したときに無駄なAPI呼び出しをしないよう
+# 待受時間の終わり際まで生成を遅らせる
+SPECULATE_LEAD = 30
+
+
+class Speculator:
+    """AIの回答の投機的生成
+
+    budget: 投機的生成に使うtoken数の上限。
+        送信するtoken数と回答のmax_tokensを見積もって予約し、
+        回答後に実際の回答token数で精算する。
+    audio: Trueで回答の音声も先に合成する
+    """
+
+    def __init__(self, ai: AI, budget: int, audio: bool = False):
+        self.ai = ai
+        self.budget = budget
+        self.audio = audio
+        self.spent = 0  # 投機的生成に消費したtoken数
+        self.saved = 0  # 投機的生成が使われた回数
+        self.prompt: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, chat_messages: list[Message], prompt: str):
+        """promptに対する回答の投機的生成をバックグラウンドで始める
+        空文字のpromptはタイムアウトしても再度入力待ちとなるので生成しない
+        """
+        self.discard()
+        if not prompt.strip():
+            return
+        self.prompt = prompt
+        self.task = asyncio.create_task(
+            self._run(list(chat_messages), prompt))
+
+    def discard(self):
+        """生成途中または生成済みの回答を破棄する"""
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        self.prompt = None
+
+    async def take(self, user_input: str):
+        """user_inputに対して生成済みの回答があれば
+        (response_messages, audio)を返し、なければNoneを返す。
+        生成途中であれば最初から問い合わせるより早いので完了を待つ。
+        """
+        task, prompt = self.task, self.prompt
+        self.task = self.prompt = None
+        if task is None:
+            return None
+        if user_input != prompt:  # ユーザーが入力したら破棄
+            task.cancel()
+            return None
+        try:
+            speculated = await task
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:  # 投機的生成の失敗は通常の問い合わせで取り返す
+            print(f"Warning: 投機的生成に失敗しました。{e}")
+            return None
+        if speculated is not None:
+            self.saved += 1
+        return speculated
+
+    def _estimate(self, chat_messages: list[Message]) -> int:
+        """投機的生成で消費するtoken数の見積もり"""
+        contents = "\n".join([self.ai.system_role, self.ai.chat_summary] +
+                             [m.content for m in chat_messages])
+        return self.ai.token_length(contents) + self.ai.max_tokens
+
+    async def _run(self, chat_messages: list[Message], prompt: str):
+        """タイムアウト直前まで待ってから回答を生成する"""
+        await asyncio.sleep(max(TIMEOUT - SPECULATE_LEAD, 0))
+        chat_messages.append(Message(str(Role.USER), prompt))
+        cost = self._estimate(chat_messages)
+        if self.spent + cost > self.budget:  # 上限を超えるなら生成しない
+            return None
+        self.spent += cost
+        response_messages = await self.ai.post(chat_messages)
+        ai_response = response_messages[-1].content
+        # 予約したmax_tokensを実際の回答token数で精算
+        self.spent -= self.ai.max_tokens - self.ai.token_length(ai_response)
+        audio = None
+        if self.audio and self.ai.voice > 0:
+            speech = self.ai.speech_text(ai_response)
+            if speech:
+                from lib.voicevox_audio import get_voice_binary
+                loop = asyncio.get_running_loop()
+                audio = await loop.run_in_executor(None, get_voice_binary,
+                                                   speech, self.ai.voice,
+                                                   self.ai.speaker)
+        return response_messages, audio
@@ -0,0 +1,89 @@
+"""イベントループ上で標準入力を読むリーダー
+スレッドでinput()を待たないので、入力待ちをキャンセルしても
+スレッドが残らず、次の入力を古い読み手に奪われない。
+
+# USAGE
+reader = get_reader()
+text = await reader.multi_input("あなた: ")
+"""
+import os
+import sys
+import codecs
+import asyncio
+from typing import Optional
+
+
+class StdinReader:
+    """add_readerで標準入力を読み、行単位でキューへ積む
+    読み込んだ行はキャンセルされても捨てずに次の読み込みで返す
+    """
+
+    def __init__(self, fd: Optional[int] = None):
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self.lines: asyncio.Queue = asyncio.Queue()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""  # 改行が来ていない読みかけの文字列
+        self.pending: list[str] = []  # 入力確定前の複数行入力
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.eof = False
+
+    def start(self):
+        """実行中のイベントループで標準入力の監視を始める
+        add_readerが使えない環境ではNotImplementedErrorを送出する
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop or self.eof:
+            return
+        try:
+            loop.add_reader(self.fd, self._on_readable)
+        except (PermissionError, ValueError) as e:  # 通常ファイルなど
+            raise NotImplementedError(e) from e
+        self.loop = loop
+
+    def _on_readable(self):
+        data = os.read(self.fd, 4096)
+        if not data:  # EOF
+            self.loop.remove_reader(self.fd)
+            self.eof = True
+            self.lines.put_nowait(None)
+            return
+        self.buffer += self.decoder.decode(data)
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            self.lines.put_nowait(line.rstrip("\r"))
+
+    async def readline(self) -> str:
+        """1行読み込む"""
+        self.start()
+        line = await self.lines.get()
+        if line is None:
+            self.lines.put_nowait(None)  # 以降の読み込みもEOF
+            raise EOFError
+        return line
+
+    async def multi_input(self, prompt: str = "") -> str:
+        """複数行読み込み
+        空行で入力確定
+        """
+        self.start()
+        if not self.pending:
+            print(prompt, end="", flush=True)
+        while True:
+            line = await self.readline()
+            if self.pending and line == "":
+                break
+            self.pending.append(line)
+        first, *rest = self.pending
+        self.pending = []
+        return first + "\n".join(rest)
+
+
+_reader: Optional[StdinReader] = None
+
+
+def get_reader() -> StdinReader:
+    """プロセスで共有する標準入力のリーダー"""
+    global _reader
+    if _reader is None:
+        _reader = StdinReader()
+    return _reader
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""要約(# Summary Content, # User Preference)の重複した箇条書きの圧縮
+API呼び出しなしで、文字n-gramのMinHashによりほぼ同じ内容の箇条書きを見つけ、
+新しい方の位置に1つにまとめる。
+まとめるのは書き方がほぼ同じもの(「コーヒーが好き」と「コーヒーが好きです」)と、
+短い箇条書き全体が別の箇条書きの句読点で区切られた一部になっているもの
+(「Likes coffee」と「Likes coffee, especially in the morning」)だけ。
+前者は新しい方の書き方を、後者は情報の多い長い方の書き方を残す。
+「Likes tea」と「Likes tea ceremony」のように区切りなく続くものは
+別の内容のことがあるのでまとめない。
+「Drinking coffee」と「Likes coffee」のような言い換えは文字の一致が少なく、
+「Likes tea」と「Likes coffee」のような別の内容と区別できないのでまとめない。
+要約はAPIへ送るたびにシステムプロンプトのtoken数となるので、
+重複を除くと毎回の送信token数が減る。
+
+# USAGE
+summary, removed = compact_summary(chat_summary)
+
+長期記憶に保存された要約を圧縮する
+$ python -m lib.summary_dedup chatgpt-assistant.txt --memory sqlite
+"""
+import re
+import hashlib
+import argparse
+import unicodedata
+from typing import Optional
+
+# 同じ内容とみなす文字n-gramのJaccard係数
+# 0.5では「猫が好き」と「犬が好き」のような別の内容までまとめてしまう
+THRESHOLD = 0.7
+# 文字n-gramの数がこれ以下の箇条書きは他の箇条書きに含まれるかも比較する
+SHORT = 12
+# MinHashのハッシュ関数の数
+NUM_PERM = 64
+# LSHのバンド数 (NUM_PERM / BANDS 行ずつ比較する)
+BANDS = 32
+# MinHashで使うメルセンヌ素数
+PRIME = (1 << 61) - 1
+
+CJK = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]")
+NOISE = re.compile(r"[\W_]+")
+# 箇条書きの中で句や節を区切る記号
+CLAUSE_BREAK = r"[,，、。.!！?？:：;；()（）「」『』\[\]\-—]"
+BULLET = re.compile(r"^\s*[-*・]\s+")
+# ハッシュ関数 h(x) = (a * x + b) mod PRIME の係数
+COEFFS = [(int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8)
+                          .digest(), "big") % (PRIME - 1) + 1,
+           int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8)
+                          .digest(), "big") % PRIME)
+          for i in range(NUM_PERM)]
+
+
+def shingles(text: str) -> set[str]:
+    """正規化した文字n-gramの集合
+    日本語など分かち書きしない文字を含めば2-gram、それ以外は3-gram
+    """
+    text = NOISE.sub("", unicodedata.normalize("NFKC", text).lower())
+    n = 2 if CJK.search(text) else 3
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def normalize(text: str) -> str:
+    """比較用に正規化した箇条書き。句読点は残す"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(text.split()).rstrip("。.!！")
+
+
+def contains(longer: str, shorter: str) -> bool:
+    """shorter全体がlongerの中に句読点で区切られた句として現れればTrue"""
+    longer, shorter = normalize(longer), normalize(shorter)
+    if not shorter or len(shorter) >= len(longer):
+        return False
+    pattern = (rf"(?:^|{CLAUSE_BREAK}\s*){re.escape(shorter)}"
+               rf"\s*(?:{CLAUSE_BREAK}|$)")
+    return re.search(pattern, longer) is not None
+
+
+def minhash(shingle_set: set[str]) -> tuple[int, ...]:
+    """shingleの集合のMinHash署名"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(),
+                       "big") for s in shingle_set
+    ]
+    if not hashes:
+        return tuple([PRIME] * NUM_PERM)
+    return tuple(
+        min((a * h + b) % PRIME for h in hashes) for a, b in COEFFS)
+
+
+def duplicate_groups(items: list[str],
+                     threshold: float = THRESHOLD) -> list[list[int]]:
+    """ほぼ同じ内容の要素のインデックスをグループにまとめる
+    LSHで候補の組を絞り込み、Jaccard係数がthreshold以上の組と、
+    一方が他方に含まれる組を同じグループとする
+    含まれる短い要素はJaccard係数が低くLSHで漏れやすいので、全ての要素と比較する
+    """
+    sets = [shingles(t) for t in items]
+    rows = NUM_PERM // BANDS
+    buckets: dict[tuple, list[int]] = {}
+    for i, s in enumerate(sets):
+        if not s:
+            continue
+        signature = minhash(s)
+        for band in range(BANDS):
+            key = (band, signature[band * rows:(band + 1) * rows])
+            buckets.setdefault(key, []).append(i)
+    parent = list(range(len(items)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    candidates: set[tuple[int, int]] = set()
+    for members in buckets.values():
+        for x, i in enumerate(members):
+            for j in members[x + 1:]:
+                candidates.add((i, j))
+    for i, s in enumerate(sets):
+        if s and len(s) <= SHORT:
+            candidates.update((min(i, j), max(i, j))
+                              for j, t in enumerate(sets) if t and j != i)
+    for i, j in candidates:
+        if (jaccard(sets[i], sets[j]) >= threshold
+                or contains(items[i], items[j])
+                or contains(items[j], items[i])):
+            parent[find(i)] = find(j)
+    groups: dict[int, list[int]] = {}
+    for i in range(len(items)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def dedup_bullets(bullets: list[str], threshold: float = THRESHOLD) -> list[str]:
+    """重複した箇条書きを1つにまとめる
+    後に書かれたものほど新しいとみなし、グループの中で最も新しい書き方を
+    最も新しい位置に残す。
+    ただし最も新しい書き方を含む長い書き方があれば、情報を失わないよう
+    その中で最も長いものを最も新しい位置に残す
+    """
+    texts = [BULLET.sub("", b) for b in bullets]
+    keep: dict[int, str] = {}
+    for group in duplicate_groups(texts, threshold):
+        newest = max(group)
+        containers = [i for i in group if contains(texts[i], texts[newest])]
+        chosen = max(containers, key=lambda i: (len(texts[i]), i),
+                     default=newest)
+        keep[newest] = bullets[chosen]
+    return [keep[i] for i in range(len(bullets)) if i in keep]
+
+
+def compact_summary(summary: str,
+                    threshold: float = THRESHOLD) -> tuple[str, int]:
+    """要約の見出し(# ...)ごとに重複した箇条書きをまとめる
+    Return: (圧縮した要約, 取り除いた箇条書きの数)
+    """
+    lines = summary.split("\n")
+    compacted: list[str] = []
+    bullets: list[str] = []
+    removed = 0
+
+    def flush():
+        nonlocal removed
+        kept = dedup_bullets(bullets, threshold)
+        removed += len(bullets) - len(kept)
+        compacted.extend(kept)
+        bullets.clear()
+
+    for line in lines:
+        if BULLET.match(line):
+            bullets.append(line)
+            continue
+        flush()
+        compacted.append(line)
+    flush()
+    return "\n".join(compacted), removed
+
+
+def compact_memory(filename: str,
+                   backend: Optional[str] = "gist",
+                   threshold: float = THRESHOLD,
+                   dry_run: bool = False) -> int:
+    """長期記憶に保存された要約を圧縮して保存し直す
+    Return: 取り除いた箇条書きの数
+    """
+    from lib.memory import open_memory
+    memory = open_memory(filename, backend)
+    summary, removed = compact_summary(memory.get(), threshold)
+    if removed and not dry_run:
+        memory.patch(summary)
+    return removed
+
+
+if __name__ == "__main__":
+    from lib.memory import BACKENDS
+    parser = argparse.ArgumentParser(description="要約の重複した箇条書きを圧縮する")
+    parser.add_argument("filename", help="長期記憶のファイル名")
+    parser.add_argument("--memory",
+                        choices=BACKENDS,
+                        default="gist",
+                        help="長期記憶のストレージ(default=gist)")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=THRESHOLD,
+                        help=f"同じ内容とみなすJaccard係数(default={THRESHOLD})")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="保存せずに取り除く数だけを表示する")
+    args = parser.parse_args()
+    n = compact_memory(args.filename, args.memory, args.threshold,
+                       args.dry_run)
+    print(f"{n}個の重複した箇条書きを取り除きました。")
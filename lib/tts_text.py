@@ -0,0 +1,94 @@
+"""音声合成へ渡す前のテキストの前処理
+Markdownの記号やコードブロック、URLは読み上げても意味がなく、
+音声合成の時間とWeb APIのポイント(1500+100*文字数)を消費するので、
+取り除くか短い言葉に置き換える。
+数式や比較の演算子(= < > * ^ など)は意味を持つので読み上げる言葉に置き換える。
+
+# USAGE
+speech, saved = preprocess("```python\\nprint(1)\\n```\\n詳しくは https://example.com")
+print(speech)  # コードは省略します。 詳しくは リンク
+"""
+import re
+
+# 1回の読み上げの最大文字数。0で制限しない
+MAX_CHARS = 300
+# コードブロックの代わりに読み上げる言葉
+CODE = "コードは省略します。"
+# URLの代わりに読み上げる言葉
+URL = "リンク"
+# 最大文字数で打ち切ったときに読み上げる言葉
+ELLIPSIS = "以下省略。"
+
+CODE_BLOCK = re.compile(r"```.*?(```|\Z)", re.DOTALL)
+INLINE_CODE = re.compile(r"`([^`\n]*)`")
+# URL中の対応する括弧(Wikipediaの記事名など)はURLの一部とする
+MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\((?:[^()\s]|\([^()\s]*\))*\)")
+URL_PATTERN = re.compile(r"https?://(?:[^\s()<>\]）」]|\([^\s()]*\))+")
+HEADING = re.compile(r"^\s{0,3}#{1,6}\s*", re.MULTILINE)
+LIST_MARKER = re.compile(r"^\s*(?:[-*+・]|\d+[.)])\s+", re.MULTILINE)
+QUOTE = re.compile(r"^\s*>+\s?", re.MULTILINE)
+TABLE_RULE = re.compile(r"^\s*\|?\s*:?-{3,}.*$", re.MULTILINE)
+EMPHASIS = re.compile(r"(\*{1,3}|_{2,3}|~~)(\S.*?\S|\S)\1")
+# 数式や比較の演算子は読み上げる言葉へ置き換える
+OPERATORS = {
+    "==": "イコール",
+    "!=": "ノットイコール",
+    "<=": "小なりイコール",
+    ">=": "大なりイコール",
+    "->": "やじるし",
+    "=>": "やじるし",
+    "=": "イコール",
+    "<": "小なり",
+    ">": "大なり",
+    "\\": "バックスラッシュ",
+}
+OPERATOR = re.compile("|".join(re.escape(o) for o in OPERATORS))
+# *と^は英数字の値に両側の空白の有無を揃えて挟まれたときだけ演算子とみなす
+# 強調の*より先に置き換え、a*b*cを強調と読み違えないようにする
+MULTIPLY = re.compile(r"(?<=[0-9A-Za-z)])(?:\*|\s\*\s)(?=[0-9A-Za-z(])")
+POWER = re.compile(r"(?<=[0-9A-Za-z)])(?:\^|\s\^\s)(?=[0-9A-Za-z(])")
+# Markdownの書式にしか使われない記号は読み上げずに取り除く
+SYMBOLS = re.compile(r"[|#`*]+")
+REPEATED = re.compile(r"([!！?？。、.,ー〜~…])\1+")
+SPACES = re.compile(r"\s+")
+SENTENCE_END = re.compile(r"[。．.！!？?]")
+
+
+def truncate(text: str, max_chars: int) -> str:
+    """max_chars文字以内の最後の文末で打ち切る"""
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    head = text[:max_chars]
+    ends = [m.end() for m in SENTENCE_END.finditer(head)]
+    if ends:
+        head = head[:ends[-1]]
+    return head + ELLIPSIS
+
+
+def preprocess(text: str,
+               max_chars: int = MAX_CHARS,
+               code: str = CODE,
+               url: str = URL) -> tuple[str, int]:
+    """読み上げ用に整形したテキストと、削減した文字数を返す
+
+    max_chars: 1回の読み上げの最大文字数。0で制限しない
+    code: コードブロックの代わりに読み上げる言葉
+    url: URLの代わりに読み上げる言葉
+    """
+    speech = CODE_BLOCK.sub(f" {code} ", text)
+    speech = INLINE_CODE.sub(r"\1", speech)
+    speech = MARKDOWN_LINK.sub(r"\1", speech)
+    speech = URL_PATTERN.sub(f" {url} ", speech)
+    speech = TABLE_RULE.sub("", speech)
+    speech = HEADING.sub("", speech)
+    speech = LIST_MARKER.sub("", speech)
+    speech = QUOTE.sub("", speech)
+    speech = MULTIPLY.sub(" かける ", speech)
+    speech = POWER.sub(" じょう ", speech)
+    speech = EMPHASIS.sub(r"\2", speech)
+    speech = OPERATOR.sub(lambda m: f" {OPERATORS[m.group()]} ", speech)
+    speech = SYMBOLS.sub(" ", speech)
+    speech = REPEATED.sub(r"\1", speech)
+    speech = SPACES.sub(" ", speech).strip()
+    speech = truncate(speech, max_chars)
+    return speech, max(len(text) - len(speech), 0)
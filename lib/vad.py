@@ -0,0 +1,105 @@
+"""音声区間検出(VAD: Voice Activity Detection)
+16bit PCMを短いフレームに分け、音量(RMS)とゼロ交差率(ZCR)から
+発話区間を検出する。
+音声認識へ送る前に前後の無音を取り除き、長い発話を分割し、
+発話を含まない録音は認識へ送らないために使う。
+
+# USAGE
+segments = speech_segments(pcm, sample_rate=16000)
+for start, end in segments:
+    print(pcm[start:end])
+"""
+from array import array
+from math import sqrt
+from typing import Optional
+
+# 1フレームの長さ(秒)
+FRAME_DURATION = 0.02
+# 発話とみなす音量の雑音レベルに対する倍率
+SPEECH_RATIO = 2.5
+# 無声子音(さ行、は行など)とみなすゼロ交差率
+# 音量が閾値の半分以上でZCRがこの値を超えるフレームも発話とみなす
+UNVOICED_ZCR = 0.25
+# 発話区間の前後に残す余白(秒)
+PADDING = 0.2
+# この長さより短い無音で区切られた発話区間は結合する(秒)
+MIN_SILENCE = 0.3
+# この長さより短い発話区間は雑音として捨てる(秒)
+MIN_SPEECH = 0.15
+# この長さより長い発話区間は分割する(秒)
+MAX_SPEECH = 15.0
+
+
+def rms(buffer: bytes) -> float:
+    """16bit PCMの二乗平均平方根(音量)"""
+    samples = array("h", buffer)
+    if not samples:
+        return 0.0
+    return sqrt(sum(s * s for s in samples) / len(samples))
+
+
+def zcr(buffer: bytes) -> float:
+    """16bit PCMのゼロ交差率"""
+    samples = array("h", buffer)
+    if len(samples) < 2:
+        return 0.0
+    crossings = sum(1 for a, b in zip(samples, samples[1:])
+                    if (a < 0) != (b < 0))
+    return crossings / (len(samples) - 1)
+
+
+def noise_floor(energies: list[float]) -> float:
+    """フレームの音量の下位10%点を雑音レベルとする"""
+    if not energies:
+        return 0.0
+    return sorted(energies)[len(energies) // 10]
+
+
+def speech_segments(pcm: bytes,
+                    sample_rate: int,
+                    threshold: Optional[float] = None) -> list[tuple[int, int]]:
+    """16bit PCMの発話区間を(開始, 終了)のバイト位置のリストで返す
+
+    threshold: 発話とみなす音量。Noneなら雑音レベルのSPEECH_RATIO倍
+    """
+    frame_bytes = int(sample_rate * FRAME_DURATION) * 2
+    frames = [
+        pcm[i:i + frame_bytes]
+        for i in range(0, len(pcm) - frame_bytes + 1, frame_bytes)
+    ]
+    energies = [rms(f) for f in frames]
+    if threshold is None:
+        threshold = max(noise_floor(energies) * SPEECH_RATIO, 1.0)
+    voiced = [
+        e > threshold or (e > threshold / 2 and zcr(f) > UNVOICED_ZCR)
+        for f, e in zip(frames, energies)
+    ]
+
+    def to_frames(seconds: float) -> int:
+        return max(int(seconds / FRAME_DURATION), 1)
+
+    # 発話フレームの連続を区間にまとめ、短い無音を挟む区間を結合する
+    segments: list[list[int]] = []
+    for i, v in enumerate(voiced):
+        if not v:
+            continue
+        if segments and i - segments[-1][1] <= to_frames(MIN_SILENCE):
+            segments[-1][1] = i + 1
+        else:
+            segments.append([i, i + 1])
+    # 短すぎる区間を捨て、前後に余白を付ける
+    padding = to_frames(PADDING)
+    segments = [[max(s - padding, 0),
+                 min(e + padding, len(frames))] for s, e in segments
+                if e - s >= to_frames(MIN_SPEECH)]
+    # 長すぎる区間は後半の最も静かなフレームで分割する
+    max_frames = to_frames(MAX_SPEECH)
+    split: list[tuple[int, int]] = []
+    for s, e in segments:
+        while e - s > max_frames:
+            window = range(s + max_frames // 2, s + max_frames)
+            cut = min(window, key=energies.__getitem__)
+            split.append((s, cut))
+            s = cut
+        split.append((s, e))
+    return [(s * frame_bytes, e * frame_bytes) for s, e in split]
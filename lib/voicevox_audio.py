@@ -9,12 +9,21 @@ fast=Trueオプションで高速URLを使用します。
 初期のポイント: 1,000,000ポイント
 
 確認の仕方はcheck_point()
+
+ローカルのVOICEVOXエンジンは環境変数VOICEVOX_LOCAL_URLSに
+カンマ区切りで複数指定でき、文ごとに並列で音声合成する。
+$ export VOICEVOX_LOCAL_URLS=http://localhost:50021,http://localhost:50022
 """
 import os
+import re
 from io import BytesIO
 import json
-from typing import Union
-from time import sleep
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+from time import sleep, monotonic
 import argparse
 import wave
 import requests
@@ -26,6 +35,16 @@ apikey = os.getenv("VOICEVOX_API_KEY")
 url = "https://api.tts.quest/v1"
 fast_url = "https://api.su-shiki.com/v2"
 local_url = "http://localhost:50021"
+local_urls = os.getenv("VOICEVOX_LOCAL_URLS", local_url).split(",")
+# 停止したエンジンの死活確認をやり直す間隔(秒)
+HEALTH_INTERVAL = 30
+# ローカルエンジンへのリクエストのタイムアウト(接続, 読み込み)(秒)
+# 読み込みのタイムアウトは1文の合成にかかる時間に対するもの
+LOCAL_TIMEOUT = (1, 60)
+# 合成が読み込みのタイムアウトを過ぎたときにやり直す回数
+READ_RETRIES = 1
+# 中断できない再生の警告を表示済みならTrue
+_warned_uninterruptible = False
 
 
 def check_point() -> dict:
@@ -35,23 +54,160 @@ def check_point() -> dict:
     return requests.get(f"{fast_url}/api", params={"key": apikey}).text
 
 
-def audio_query(text: str, speaker: Union[int, CV] = 0) -> requests.Response:
+def audio_query(text: str,
+                speaker: Union[int, CV] = 0,
+                base_url: str = local_url) -> requests.Response:
     """音声の合成用クエリの作成"""
     headers = {"accept": "application/json"}
     params = {"text": text, "speaker": int(speaker)}
-    return requests.post(f"{local_url}/audio_query",
+    return requests.post(f"{base_url}/audio_query",
                          headers=headers,
-                         params=params)
+                         params=params,
+                         timeout=LOCAL_TIMEOUT)
 
 
-def synthesis(data, speaker: Union[int, CV] = CV(0)) -> requests.Response:
+def synthesis(data,
+              speaker: Union[int, CV] = CV(0),
+              base_url: str = local_url) -> requests.Response:
     """音声合成するAPI"""
     headers = {"accept": "audio/wav", "Content-Type": "application/json"}
     params = {"speaker": int(speaker)}
-    return requests.post(f"{local_url}/synthesis",
+    return requests.post(f"{base_url}/synthesis",
                          headers=headers,
                          data=json.dumps(data),
-                         params=params)
+                         params=params,
+                         timeout=LOCAL_TIMEOUT)
+
+
+class EnginePool:
+    """ローカルVOICEVOXエンジンのプール
+    処理中のリクエストが最も少ないエンジンへ割り振る。
+    接続できなかったエンジンはHEALTH_INTERVAL秒間使わず、
+    その後の割り振り時に/versionへ問い合わせて復帰させる。
+    """
+
+    def __init__(self, urls: list[str]):
+        self.urls = [u.strip().rstrip("/") for u in urls if u.strip()]
+        self.outstanding = {u: 0 for u in self.urls}  # 処理中のリクエスト数
+        self.down: dict[str, float] = {}  # 停止したエンジンと停止を検知した時刻
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def is_alive(self, base_url: str) -> bool:
+        """エンジンの死活確認"""
+        try:
+            requests.get(f"{base_url}/version",
+                         timeout=LOCAL_TIMEOUT[0]).raise_for_status()
+        except requests.RequestException:
+            return False
+        return True
+
+    def _revive(self):
+        """停止してからHEALTH_INTERVAL秒経ったエンジンの死活確認をやり直す"""
+        now = monotonic()
+        with self.lock:
+            expired = [
+                u for u, t in self.down.items() if now - t >= HEALTH_INTERVAL
+            ]
+            for u in expired:  # 確認中に他のスレッドが重ねて確認しないように
+                self.down[u] = now
+        for u in expired:
+            if self.is_alive(u):
+                with self.lock:
+                    self.down.pop(u, None)
+
+    def acquire(self) -> str:
+        """処理中のリクエストが最も少ない稼働中のエンジン"""
+        self._revive()
+        with self.lock:
+            alive = [u for u in self.urls if u not in self.down]
+            if not alive:
+                raise requests.ConnectionError("稼働中のVOICEVOXエンジンがありません")
+            base_url = min(alive, key=self.outstanding.__getitem__)
+            self.outstanding[base_url] += 1
+        return base_url
+
+    def release(self, base_url: str, failed: bool = False):
+        """リクエストの完了。failed=Trueでエンジンを停止扱いにする"""
+        with self.lock:
+            self.outstanding[base_url] -= 1
+            if failed:
+                self.down[base_url] = monotonic()
+
+    def synthesize(self, text: str, speaker: Union[int, CV] = CV(0)) -> bytes:
+        """textを稼働中のエンジンで音声合成したwavバイナリ
+        接続できないかエンジンのエラー(5xx)なら他のエンジンでやり直し、
+        リクエストの誤り(4xx)はどのエンジンでも失敗するのでwave.Errorを送出する
+        合成が遅いだけのエンジンは停止扱いにせずREAD_RETRIES回までやり直し、
+        それでも遅ければ有料のWeb APIへ切り替えずにwave.Errorを送出する
+        """
+        retries = READ_RETRIES
+        while True:
+            base_url = self.acquire()
+            try:
+                body = audio_query(text, speaker, base_url)
+                body.raise_for_status()
+                response = synthesis(body.json(), speaker, base_url)
+                response.raise_for_status()
+            except requests.ReadTimeout as e:
+                self.release(base_url)
+                if retries > 0:
+                    retries -= 1
+                    continue
+                raise wave.Error(f"VOICEVOXエンジンの合成が遅すぎます。{e}") from e
+            except (requests.ConnectionError, requests.Timeout):
+                self.release(base_url, failed=True)
+                continue
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status is None or status >= 500:
+                    self.release(base_url, failed=True)
+                    continue
+                self.release(base_url)
+                raise wave.Error(f"VOICEVOXエンジンが{status}を返しました。") from e
+            except BaseException:
+                self.release(base_url)
+                raise
+            self.release(base_url)
+            return response.content
+
+    def synthesize_all(self,
+                       text: str,
+                       speaker: Union[int, CV] = CV(0),
+                       stop: Optional[threading.Event] = None) -> bytes:
+        """textを文に分けてエンジンの数だけ並列に音声合成し、
+        1つのwavバイナリへ結合する
+        エンジンが1つでも文ごとに合成し、1回のリクエストを短く保つ
+        stopがセットされたら残りの文は合成せずに空のバイナリを返す
+        """
+        sentences = split_sentences(text)
+        if len(sentences) < 2:
+            return self.synthesize(text, speaker)
+
+        def synthesize(sentence: str) -> Optional[bytes]:
+            if stop is not None and stop.is_set():
+                return None
+            return self.synthesize(sentence, speaker)
+
+        with ThreadPoolExecutor(max_workers=len(self)) as executor:
+            wavs = list(executor.map(synthesize, sentences))
+        if None in wavs:
+            return b""
+        audio = sum((build_audio(w) for w in wavs[1:]), build_audio(wavs[0]))
+        buffer = BytesIO()
+        audio.export(buffer, format="wav")
+        return buffer.getvalue()
+
+
+engine_pool = EnginePool(local_urls)
+
+
+def split_sentences(text: str) -> list[str]:
+    """句点、感嘆符、疑問符、改行で文に分ける"""
+    sentences = re.split(r"(?<=[。．.！!？?\n])", text)
+    return [s for s in sentences if s.strip()]
 
 
 def get_voice(
@@ -84,6 +240,26 @@ def get_voice(
         return response
 
 
+def get_voice_binary(text,
+                     mode: Union[int, Mode],
+                     speaker: Union[int, CV] = CV(0),
+                     stop: Optional[threading.Event] = None) -> bytes:
+    """音声合成したaudioバイナリを得る
+    LOCALはエンジンのプールで並列に音声合成し、
+    稼働中のエンジンがなければWeb API(FAST, APIキーがなければSLOW)へ切り替える
+    stopがセットされたら合成をやめて空のバイナリを返す
+    """
+    if mode == Mode.LOCAL:
+        try:
+            return engine_pool.synthesize_all(text, speaker, stop)
+        except requests.ConnectionError as e:
+            mode = Mode.FAST if apikey else Mode.SLOW
+            print(f"Warning: {e} {mode.name}モードを使います。")
+    if stop is not None and stop.is_set():
+        return b""
+    return get_voice(text, mode, speaker).content
+
+
 def is_wav_file(filename):
     """ ファイルがWAVフォーマットであるかどうかを判定する """
     try:
@@ -114,11 +290,89 @@ def play_voice(text,
                mode: Union[int, Mode] = Mode.SLOW,
                wav_file=None):
     """テキストの再生"""
-    resp = get_voice(text, mode, speaker)
-    audio = build_audio(resp.content, wav_file)
+    play_audio(get_voice_binary(text, mode, speaker), wav_file)
+
+
+def play_audio(binary, wav_file=None):
+    """合成済みaudioバイナリの再生"""
+    audio = build_audio(binary, wav_file)
     play(audio)
 
 
+async def async_play_voice(text,
+                           speaker: Union[int, CV] = CV.四国めたんあまあま,
+                           mode: Union[int, Mode] = Mode.SLOW,
+                           wav_file=None):
+    """テキストの中断可能な再生
+    キャンセルされたら音声合成と再生を止める
+    """
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, get_voice_binary, text, mode, speaker,
+                                  stop)
+    try:
+        binary = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        stop.set()  # 合成を待っている文があれば合成しない
+        raise
+    await async_play_audio(binary, wav_file)
+
+
+async def async_play_audio(binary, wav_file=None):
+    """合成済みaudioバイナリの中断可能な再生
+    simpleaudioがあればそれを使い、なければffplayのサブプロセスで再生する。
+    どちらもなければ中断できないpydubのplayで再生する。
+    """
+    audio = build_audio(binary, wav_file)
+    try:
+        import simpleaudio
+    except ImportError:
+        await _async_play_with_ffplay(audio)
+        return
+    play_obj = simpleaudio.play_buffer(audio.raw_data, audio.channels,
+                                       audio.sample_width, audio.frame_rate)
+    try:
+        while play_obj.is_playing():
+            await asyncio.sleep(0.05)
+    finally:
+        play_obj.stop()
+
+
+def _warn_uninterruptible():
+    """再生を中断できないことを最初の1回だけ警告する"""
+    global _warned_uninterruptible
+    if _warned_uninterruptible:
+        return
+    _warned_uninterruptible = True
+    print("Warning: simpleaudioもffplayも見つからないため、音声再生を中断できません。"
+          "pip install simpleaudio でインストールしてください。")
+
+
+async def _async_play_with_ffplay(audio: AudioSegment):
+    """ffplayのサブプロセスで再生し、キャンセルされたらプロセスを止める"""
+    with tempfile.NamedTemporaryFile("w+b", suffix=".wav") as f:
+        audio.export(f.name, "wav")
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffplay",
+                "-nodisp",
+                "-autoexit",
+                "-hide_banner",
+                f.name,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        except FileNotFoundError:  # ffplayもなければ中断できない再生
+            _warn_uninterruptible()
+            await asyncio.get_running_loop().run_in_executor(None, play, audio)
+            return
+        try:
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="VOICEVOX CV")
     parser.add_argument("-s",
@@ -138,7 +392,9 @@ if __name__ == "__main__":
     #     resp = get_voice(text)
     # except requests.HTTPError:
     #     resp = get_voice(text, mode=Mode.FAST)
-    print(Mode(args.voicemode))
-    play_voice(args.text,
+    from lib.tts_text import preprocess
+    text, saved = preprocess(args.text)
+    print(Mode(args.voicemode), f"saved {saved} chars")
+    play_voice(text,
                speaker=args.speaker,
                mode=Mode(args.voicemode))